@@ -0,0 +1,98 @@
+"""Per-call latency of Database methods with and without pooled connections.
+
+Run from the repository root:
+
+    python benchmarks/bench_connections.py [--calls 2000]
+
+"per-call" reproduces the old behaviour where every Database method opened
+a new connection to user.db, "pooled" uses the ConnectionManager.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from contextlib import contextmanager
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'geniustmusicplayer'))
+
+from db import ConnectionManager, Database  # noqa: E402
+from utils import Song, Playlist  # noqa: E402
+
+
+class PerCallConnections(ConnectionManager):
+    """Opens a new connection on every call, like the old get_cursor.
+
+    Calls inside a write transaction use the transaction's connection, as a
+    second connection would wait on the transaction's lock.
+    """
+
+    def connection(self):
+        con = getattr(self._local, 'open', None)
+        return con if con is not None else self._connect()
+
+    @contextmanager
+    def transaction(self):
+        local = self._local
+        if getattr(local, 'open', None) is not None:
+            with super().transaction() as con:
+                yield con
+            return
+        local.open = self._connect()
+        try:
+            with super().transaction() as con:
+                yield con
+        finally:
+            local.open.close()
+            local.open = None
+
+
+def make_playlist(size):
+    return Playlist(
+        [Song(id=i, name=f'Song {i}', artist=f'Artist {i % 50}',
+              id_spotify=f'spotify{i}', isrc=f'isrc{i}')
+         for i in range(1, size + 1)],
+        current=0,
+    )
+
+
+def measure(func, calls):
+    timings = []
+    for _ in range(calls):
+        start = perf_counter()
+        func()
+        timings.append(perf_counter() - start)
+    timings.sort()
+    return timings[len(timings) // 2], timings[int(len(timings) * 0.95)]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--calls', type=int, default=2000)
+    parser.add_argument('--tracks', type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'user.db')
+        playlist = make_playlist(args.tracks)
+        Database(path).initialize(['pop'], [], directory, playlist)
+        track = playlist.tracks[-1]
+
+        print(f"{'method':<22}{'mode':<10}{'p50 (us)':>10}{'p95 (us)':>10}")
+        for mode, manager in (('per-call', PerCallConnections),
+                              ('pooled', ConnectionManager)):
+            db = Database(path)
+            db.connections = manager(path)
+            cases = (
+                ('get_track', lambda: db.get_track(track.id)),
+                ('get_playlist', db.get_playlist),
+                ('update_current_track', lambda: db.update_current_track(track)),
+            )
+            for name, func in cases:
+                p50, p95 = measure(func, args.calls)
+                print(f'{name:<22}{mode:<10}{p50 * 1e6:>10.1f}{p95 * 1e6:>10.1f}')
+            db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+"""Latency of Database methods on synthetic libraries of different sizes.
+
+Run from the repository root:
+
+    python benchmarks/bench_db.py [--sizes 1000 10000 100000] [--calls 100]
+    python benchmarks/bench_db.py --save-baseline
+    python benchmarks/bench_db.py --baseline benchmarks/bench_db_baseline.json
+
+Every size gets a fresh database in a temporary directory with that many
+favorited tracks, a tenth of which are also in the playlist. The p50, p95
+and p99 of each method are printed and, when a baseline file exists,
+compared to it. A method is reported as a regression when its p50 is more
+than --threshold slower than the baseline's, and the script then exits
+with status 1.
+
+bench_db_baseline.json is a reference baseline with the default sizes and
+calls. Timings depend on the machine, so on another machine run the script
+with --save-baseline first, before making the changes to compare.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'geniustmusicplayer'))
+
+from db import Database  # noqa: E402
+from utils import Song, Playlist  # noqa: E402
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(__file__), 'bench_db_baseline.json')
+
+
+def make_song(i):
+    return Song(
+        id=i,
+        name=f'Song {i}',
+        artist=f'Artist {i % 500}',
+        genres=['pop', 'rock'],
+        id_spotify=f'spotify{i}',
+        isrc=f'isrc{i}',
+        cover_art=f'https://example.com/{i}.jpg',
+        preview_url=f'https://example.com/{i}.mp3',
+        date_favorited=1600000000.0 + i,
+    )
+
+
+def seed(db, directory, size):
+    songs = [make_song(i) for i in range(1, size + 1)]
+    playlist = Playlist(songs[:max(size // 10, 1)], current=0)
+    db.initialize(['pop'], [], directory, playlist)
+    with db.transaction():
+        for song in songs:
+            db.add_favorites_track(song)
+    return playlist
+
+
+def percentiles(timings):
+    timings = sorted(timings)
+    return {
+        'p50': timings[len(timings) // 2],
+        'p95': timings[min(int(len(timings) * 0.95), len(timings) - 1)],
+        'p99': timings[min(int(len(timings) * 0.99), len(timings) - 1)],
+    }
+
+
+def measure(func, calls, setup=None, teardown=None):
+    """Times calls to func, excluding setup and teardown from the timings."""
+    timings = []
+    for i in range(calls):
+        if setup is not None:
+            setup(i)
+        start = perf_counter()
+        func(i)
+        timings.append(perf_counter() - start)
+        if teardown is not None:
+            teardown(i)
+    return percentiles(timings)
+
+
+def run(size, calls):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(directory, 'user.db'))
+        playlist = seed(db, directory, size)
+        tracks = playlist.tracks
+        extra = make_song(size + 1)
+        # Rewriting the whole playlist is much slower than the other calls,
+        # so it gets fewer of them on big libraries.
+        rewrites = max(min(calls, 100_000 // size), 5)
+
+        cases = (
+            ('get_playlist', dict(func=lambda i: db.get_playlist())),
+            ('get_favorites', dict(func=lambda i: db.get_favorites())),
+            ('get_user', dict(func=lambda i: db.get_user())),
+            ('update_playlist', dict(
+                func=lambda i: db.update_playlist(playlist),
+                calls=rewrites,
+            )),
+            ('add_playlist_track', dict(
+                func=lambda i: db.add_playlist_track(extra, len(tracks) // 2),
+                teardown=lambda i: db.remove_playlist_track(extra),
+            )),
+            ('update_track', dict(
+                func=lambda i: db.update_track(
+                    tracks[i % len(tracks)], 'preview_file', f'{i}.mp3'),
+            )),
+            ('update_current_track', dict(
+                func=lambda i: db.update_current_track(tracks[i % len(tracks)]),
+            )),
+        )
+        for name, case in cases:
+            case.setdefault('calls', calls)
+            results[name] = measure(**case)
+        db.close()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Returns (size, method, ratio) of the results slower than baseline."""
+    regressions = []
+    for size, methods in results.items():
+        for name, timings in methods.items():
+            previous = baseline.get(size, {}).get(name)
+            if previous is None:
+                continue
+            ratio = timings['p50'] / previous['p50']
+            if ratio > 1 + threshold:
+                regressions.append((size, name, ratio))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--calls', type=int, default=100)
+    parser.add_argument('--baseline', default=DEFAULT_BASELINE)
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='write the results to --baseline instead of comparing')
+    parser.add_argument('--threshold', type=float, default=0.25,
+                        help='slowdown of the p50 reported as a regression')
+    args = parser.parse_args()
+
+    baseline = {}
+    if not args.save_baseline and os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    elif not args.save_baseline:
+        print(f'No baseline at {args.baseline}; create one with --save-baseline.')
+
+    results = {}
+    print(f"{'tracks':>8}  {'method':<22}{'p50 (ms)':>10}{'p95 (ms)':>10}"
+          f"{'p99 (ms)':>10}{'vs base':>9}")
+    for size in args.sizes:
+        results[str(size)] = methods = run(size, args.calls)
+        for name, timings in methods.items():
+            previous = baseline.get(str(size), {}).get(name)
+            change = (f"{timings['p50'] / previous['p50']:>8.2f}x"
+                      if previous else f"{'-':>9}")
+            print(f'{size:>8}  {name:<22}'
+                  f"{timings['p50'] * 1e3:>10.3f}{timings['p95'] * 1e3:>10.3f}"
+                  f"{timings['p99'] * 1e3:>10.3f}{change}")
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+        print(f'Saved baseline to {args.baseline}')
+        return
+
+    regressions = compare(results, baseline, args.threshold)
+    for size, name, ratio in regressions:
+        print(f'REGRESSION: {name} with {size} tracks is {ratio:.2f}x slower')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
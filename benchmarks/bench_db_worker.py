@@ -0,0 +1,135 @@
+"""UI-thread time of database call sites with and without DatabaseWorker.
+
+Run from the repository root:
+
+    python benchmarks/bench_db_worker.py [--favorites 10000] [--calls 200]
+
+Every call site from the UI is timed twice: once making the call directly,
+as the UI used to, and once submitting it to a DatabaseWorker. The time
+spent on the calling thread is what a frame loses; at 60 FPS a frame has
+16.7ms.
+
+MainApp.on_stop is the exception: it waits for the worker to save the
+state before closing the database, so its worker time is the submit plus
+DatabaseWorker.shutdown. MainApp.on_pause submits the same save without
+waiting.
+"""
+import argparse
+import os
+import sys
+import tempfile
+from time import perf_counter, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'geniustmusicplayer'))
+
+from db import Database, DatabaseWorker  # noqa: E402
+from utils import Song, Playlist  # noqa: E402
+
+FRAME = 1 / 60
+
+
+def seed(db, directory, favorites):
+    playlist = Playlist(
+        [Song(id=i, name=f'Song {i}', artist=f'Artist {i}') for i in range(5)],
+        current=0,
+    )
+    db.initialize(['pop'], [], directory, playlist)
+    with db.transaction():
+        for i in range(100, 100 + favorites):
+            song = Song(id=i, name=f'Favorite {i}', artist=f'Artist {i % 500}')
+            song.date_favorited = time()
+            db.add_favorites_track(song)
+    return playlist
+
+
+def report(name, mode, timings):
+    timings.sort()
+    p50 = timings[len(timings) // 2]
+    p95 = timings[int(len(timings) * 0.95)]
+    dropped = sum(1 for t in timings if t > FRAME)
+    print(f'{name:<24}{mode:<8}{p50 * 1e3:>10.3f}{p95 * 1e3:>10.3f}{dropped:>9}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--favorites', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = Database(os.path.join(directory, 'user.db'))
+        playlist = seed(db, directory, args.favorites)
+        song = Song(id=99, name='Favorite', artist='Artist')
+        song.date_favorited = time()
+
+        def save_state():
+            with db.transaction():
+                db.update_last_pos(10)
+                db.update_volume(0.5)
+
+        def on_resume():
+            if db.get_user():
+                db.get_playlist()
+
+        def favorite():
+            db.add_favorites_track(song)
+            db.remove_favorites_track(song)
+
+        def playlist_add():
+            db.get_playlist()
+            db.add_playlist_track(song, 1)
+            db.remove_playlist_track(song)
+
+        cases = (
+            ('MainApp.on_pause', save_state),
+            ('MainApp.on_resume', on_resume),
+            ('FavoriteButton.favorite', favorite),
+            ('update_playlist_menu', db.get_playlist),
+            ('playlist_add', playlist_add),
+        )
+        # Results are delivered in a batch after the timed calls, the way
+        # Clock would deliver them on a later frame.
+        delivered = []
+        worker = DatabaseWorker(schedule=delivered.append)
+
+        print(f"{'call site':<24}{'mode':<8}{'p50 (ms)':>10}{'p95 (ms)':>10}"
+              f"{'> frame':>9}")
+        for name, func in cases:
+            timings = []
+            for _ in range(args.calls):
+                start = perf_counter()
+                func()
+                timings.append(perf_counter() - start)
+            report(name, 'direct', timings)
+
+            timings = []
+            futures = []
+            for _ in range(args.calls):
+                start = perf_counter()
+                futures.append(worker.submit(func))
+                timings.append(perf_counter() - start)
+            for future in futures:
+                future.result()
+            report(name, 'worker', timings)
+
+        timings = []
+        for _ in range(args.calls):
+            start = perf_counter()
+            save_state()
+            timings.append(perf_counter() - start)
+        report('MainApp.on_stop', 'direct', timings)
+
+        timings = []
+        for _ in range(args.calls):
+            stop_worker = DatabaseWorker(schedule=delivered.append)
+            start = perf_counter()
+            stop_worker.submit(save_state)
+            stop_worker.shutdown(wait=True)
+            timings.append(perf_counter() - start)
+        report('MainApp.on_stop', 'worker', timings)
+        worker.shutdown()
+        db.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,121 @@
+"""Latency of back-to-back API requests with and without connection reuse.
+
+Run from the repository root:
+
+    python benchmarks/bench_http.py [--requests 200] [--latency 0.005]
+
+The requests go to a local HTTPS server that waits --latency seconds
+before every TCP and TLS handshake, standing in for the round trips to the
+recommender. Both modes make the requests the way requests with a trigger
+are made. "fresh" starts a thread with a new connection for every
+request, as UrlRequest did. "pooled" runs them on Sender's thread pool
+like Sender._run does, reusing the connections of its session.
+"""
+import argparse
+import os
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import perf_counter
+
+import requests
+import urllib3
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'geniustmusicplayer'))
+
+from api import Sender  # noqa: E402
+
+urllib3.disable_warnings()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = b'{"genres": ["pop", "rock"]}'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+
+    def log_message(self, *args):
+        pass
+
+
+def start_server(latency):
+    directory = tempfile.mkdtemp()
+    cert, key = os.path.join(directory, 'cert.pem'), os.path.join(directory, 'key.pem')
+    subprocess.run(['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+                    '-subj', '/CN=localhost', '-days', '1',
+                    '-keyout', key, '-out', cert],
+                   check=True, capture_output=True)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+
+    class Server(ThreadingHTTPServer):
+        daemon_threads = True
+
+        def get_request(self):
+            # A round trip for the TCP handshake and one for TLS.
+            time.sleep(2 * latency)
+            sock, address = self.socket.accept()
+            return context.wrap_socket(sock, server_side=True), address
+
+    server = Server(('127.0.0.1', 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def fresh(url, count):
+    def request():
+        with requests.Session() as session:
+            session.trust_env = False
+            session.get(url, params={'b': 1}, verify=False).json()
+
+    for _ in range(count):
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+
+
+def pooled(url, count):
+    sender = Sender()
+    sender.session.verify = False
+    # Otherwise a CA bundle from the environment overrides verify.
+    sender.session.trust_env = False
+    for _ in range(count):
+        # What make_request hands the pool for a request with a trigger,
+        # without Kivy's Clock to report back on.
+        future = sender.executor.submit(
+            sender._fetch, url, {}, {'b': 1}, 'GET', sender.retry_policy,
+            sender.timeout, False, None, None)
+        future.result()
+    return sender.connection_stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--latency', type=float, default=0.005)
+    args = parser.parse_args()
+
+    server = start_server(args.latency)
+    url = f'https://127.0.0.1:{server.server_port}/genres'
+    print(f"{'transport':<10}{'mean (ms)':>10}{'connections':>13}")
+    for name, func in (('fresh', fresh), ('pooled', pooled)):
+        start = perf_counter()
+        stats = func(url, args.requests)
+        elapsed = (perf_counter() - start) / args.requests
+        connections = stats['connections'] if stats else args.requests
+        print(f'{name:<10}{elapsed * 1000:>10.2f}{connections:>13}')
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
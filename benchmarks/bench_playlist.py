@@ -0,0 +1,86 @@
+"""Playlist lookups with and without the id index, on a large playlist.
+
+Run from the repository root:
+
+    python benchmarks/bench_playlist.py [--tracks 10000] [--calls 2000]
+
+"scan" is Playlist as it was before TrackList, which searched the list for
+every lookup. "indexed" is the current Playlist. Lookups are made for
+random tracks, as ServerSong.playing does for every /playing message.
+"""
+import argparse
+import os
+import random
+import sys
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'geniustmusicplayer'))
+
+from utils import Song, Playlist  # noqa: E402
+
+
+class ScanPlaylist(Playlist):
+    """Playlist as it was before it had an id index."""
+
+    @property
+    def tracks(self):
+        return self._tracks
+
+    @tracks.setter
+    def tracks(self, tracks):
+        self._tracks = list(tracks)
+
+    def remove(self, track):
+        self.tracks.remove(track)
+
+    def insert(self, index, track):
+        self.tracks.insert(index, track)
+
+    def set_current(self, track):
+        self._current = self.tracks.index(track)
+
+    def get_track(self, id=None, name=None):
+        for track in self.tracks:
+            if (id and track.id == id) or (name and track.name == name):
+                return track
+
+
+def measure(func, args):
+    start = perf_counter()
+    for arg in args:
+        func(arg)
+    return (perf_counter() - start) / len(args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tracks', type=int, default=10000)
+    parser.add_argument('--calls', type=int, default=2000)
+    args = parser.parse_args()
+
+    songs = [Song(id=i, name=f'Song {i}', artist=f'Artist {i % 50}')
+             for i in range(1, args.tracks + 1)]
+    picks = random.Random(0).choices(songs, k=args.calls)
+
+    def move(playlist):
+        def move_track(track):
+            playlist.remove(track)
+            playlist.insert(len(playlist.tracks) // 2, track)
+            playlist.get_track(id=track.id)
+        return move_track
+
+    print(f"{'operation':<14}{'mode':<10}{'mean (us)':>10}")
+    for mode, cls in (('scan', ScanPlaylist), ('indexed', Playlist)):
+        playlist = cls(list(songs), current=0)
+        cases = (
+            ('get_track', lambda song: playlist.get_track(id=song.id)),
+            ('set_current', playlist.set_current),
+            ('contains', lambda song: song in playlist.tracks),
+            ('move+lookup', move(playlist)),
+        )
+        for name, func in cases:
+            print(f'{name:<14}{mode:<10}{measure(func, picks) * 1e6:>10.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+"""Memory and serialization speed of Song, before and after slots.
+
+Run from the repository root:
+
+    python benchmarks/bench_song.py [--songs 100000]
+
+"dict" is a copy of Song as it was before it had slots, serialized as
+JSON. "slots" is the current Song, serialized both as JSON and in the
+binary format of Song.to_bytes.
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from time import perf_counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'geniustmusicplayer'))
+
+from utils import Song  # noqa: E402
+
+
+class DictSong:
+    """Song as it was before it had slots."""
+
+    def __init__(self, id, name, artist, genres=None,
+                 id_spotify=None, isrc=None, cover_art=None,
+                 preview_url=None, download_url=None, preview_file=None,
+                 download_file=None, date_favorited=None, **kwargs):
+        self.id = id
+        self.name = name
+        self.artist = artist
+        self.genres = genres if genres else []
+        self.id_spotify = id_spotify
+        self.isrc = isrc
+        self.cover_art = (cover_art
+                          if cover_art is not None
+                          else 'images/empty_coverart.png'
+                          )
+        self.preview_url = preview_url
+        self.download_url = download_url
+        self.preview_file = preview_file
+        self.download_file = download_file
+        self.date_favorited = date_favorited
+
+    def to_dict(self):
+        return dict(
+            id=self.id,
+            name=self.name,
+            artist=self.artist,
+            id_spotify=self.id_spotify,
+            isrc=self.isrc,
+            cover_art=self.cover_art,
+            preview_url=self.preview_url,
+            download_url=self.download_url,
+            preview_file=self.preview_file,
+            download_file=self.download_file,
+            date_favorited=self.date_favorited,
+        )
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def bytes_to_song(cls, song):
+        if isinstance(song, bytes):
+            song = cls(**json.loads(song.decode()))
+        return song
+
+
+def make_fields(i):
+    return dict(
+        id=i,
+        name=f'Song {i}',
+        artist=f'Artist {i % 500}',
+        genres=['pop'],
+        id_spotify=f'{i:022d}',
+        isrc=f'USRC{i:08d}',
+        cover_art=f'https://images.genius.com/{i:032x}.300x300x1.jpg',
+        preview_url=f'https://p.scdn.co/mp3-preview/{i:040x}',
+        date_favorited=1600000000.0 + i,
+    )
+
+
+def memory_per_song(cls, count):
+    """Returns the bytes allocated per song for count songs."""
+    rows = [make_fields(i) for i in range(count)]
+    gc.collect()
+    tracemalloc.start()
+    songs = [cls(**row) for row in rows]
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del songs
+    # The strings are shared with rows, so this is the cost of the objects.
+    return size / count
+
+
+def throughput(func, items):
+    """Returns func's calls per second over items."""
+    start = perf_counter()
+    for item in items:
+        func(item)
+    return len(items) / (perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--songs', type=int, default=100000)
+    args = parser.parse_args()
+
+    print(f"{'song':<8}{'bytes/song':>12}")
+    for name, cls in (('dict', DictSong), ('slots', Song)):
+        print(f'{name:<8}{memory_per_song(cls, args.songs):>12.0f}')
+
+    old = [DictSong(**make_fields(i)) for i in range(args.songs)]
+    new = [Song(**make_fields(i)) for i in range(args.songs)]
+    old_json = [song.to_json().encode() for song in old]
+    new_json = [song.to_json().encode() for song in new]
+    new_binary = [song.to_bytes() for song in new]
+
+    print()
+    print(f"{'song':<8}{'format':<8}{'bytes':>7}{'encode/s':>12}{'decode/s':>12}")
+    cases = (
+        ('dict', 'json', old, lambda s: s.to_json().encode(),
+         old_json, DictSong.bytes_to_song),
+        ('slots', 'json', new, lambda s: s.to_json().encode(),
+         new_json, Song.bytes_to_song),
+        ('slots', 'binary', new, Song.to_bytes,
+         new_binary, Song.bytes_to_song),
+    )
+    for name, format, songs, encode, encoded, decode in cases:
+        size = sum(map(len, encoded)) / len(encoded)
+        print(f'{name:<8}{format:<8}{size:>7.0f}'
+              f'{throughput(encode, songs):>12,.0f}'
+              f'{throughput(decode, encoded):>12,.0f}')
+
+
+if __name__ == '__main__':
+    main()
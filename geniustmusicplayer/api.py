@@ -1,58 +1,227 @@
 import json
 import logging
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import monotonic, perf_counter, sleep, time
 from typing import Optional, List
 from urllib import parse
 
 import requests
+from requests.adapters import HTTPAdapter
 # from kivy.logger import Logger
 
+from cache import ResponseCache
 from utils import Song
 
 Logger = logging.getLogger('gtplayer')
 
 class Response:
+    """Result of a request made on Sender's thread pool.
 
-    def __init__(self, req, trigger, context: dict = None):
-        from kivy.clock import Clock
+    Once the request is done, the pool thread schedules on_result or
+    on_error on the main thread with Clock. They fill in the response and
+    call the trigger, so nothing has to poll the request.
+
+    Args:
+        trigger (ClockEvent): called once the request is done.
+        context (dict, optional): keyword arguments of the request.
+        url (str, optional): URL of the request.
+    """
+
+    def __init__(self, trigger, context: dict = None, url=None):
+        self.future = None
+        self.url = url
         self.response = None
         self.is_finished = False
         self.status_code = 0
+        self.stale = False
         self.trigger = trigger
         self.context = context if context else {}
-        self.req = req
-        self.event = Clock.schedule_interval(lambda *args: self.on_finish(
-            self.req, self.req.result), .1)
+        self.started = perf_counter()
+        self.fetched = None
+        self.finished = None
         Logger.debug('Response: Response object with trigger %s', trigger)
 
-    def on_finish(self, req, result=None, progress=None):
-        self.is_finished = req.is_finished
-        self.status_code = req.resp_status
-        if not self.is_finished:
-            return
-        Logger.debug('%s status code', req.resp_status)
-        if self.status_code == 200:
-            if req.url.startswith(Sender.API_ROOT + 'recommendations'):
-                self.response = [Song(**x) for x in result['recommendations']]
-            else:
-                self.response = result
+    @property
+    def elapsed(self):
+        """Seconds from sending the request until it was done, or None."""
+        if self.finished is None:
+            return None
+        return self.finished - self.started
+
+    @property
+    def dispatch_delay(self):
+        """Seconds from the response arriving until the trigger, or None."""
+        if self.finished is None or self.fetched is None:
+            return None
+        return self.finished - self.fetched
+
+    def on_result(self, status_code, body, stale=False):
+        self.stale = stale
+        if status_code == 200:
+            self.finish(status_code, body)
         else:
-            Logger.debug('Failed request with payload: %s', result)
+            Logger.debug('Failed request with payload: %s', body)
+            self.finish(status_code)
 
-        if self.trigger is not None:
-            Logger.debug('Trigger: Activated for %s, Payload: %s',
-                         req.url,
-                         self.response)
-            self.event.cancel()
-            if not self.trigger.is_triggered:
-                self.trigger()
+    def on_error(self, error):
+        Logger.error('Response: Request to %s failed. Reason: %s', self.url, error)
+        self.finish(None)
+
+    def finish(self, status_code, response=None):
+        if (status_code == 200
+                and self.url.startswith(Sender.API_ROOT + 'recommendations')):
+            response = [Song.shared(**x) for x in response['recommendations']]
+        self.response = response
+        self.status_code = status_code or 0
+        self.finished = perf_counter()
+        self.is_finished = True
+        Logger.debug('Response: %s status code after %.0f ms for %s',
+                     self.status_code, self.elapsed * 1000, self.url)
+        if self.fetched is not None:
+            Logger.debug('Response: %.1f ms from response to trigger for %s',
+                         self.dispatch_delay * 1000, self.url)
+        if self.trigger is not None and not self.trigger.is_triggered:
+            self.trigger()
 
     def __repr__(self):
         return (f'Response(is_finished={self.is_finished},'
-                f' trigger={True if self.trigger else False}')
+                f' trigger={True if self.trigger else False})')
+
+
+class CircuitOpenError(requests.ConnectionError):
+    """Raised instead of making a request while the circuit is open."""
+
+
+class RetryPolicy:
+    """When and how long apart failed requests are retried.
+
+    The wait before retry n is random between 0 and
+    ``min(max_delay, base_delay * 2 ** (n - 1))``, so clients that failed
+    at the same time don't all retry at the same time. Only idempotent
+    requests are retried, and only after network errors and statuses in
+    ``retry_statuses``.
+
+    Args:
+        attempts (int): most times a request is made, including the first.
+        base_delay (float): seconds the first wait is at most.
+        max_delay (float): seconds any wait is at most.
+        retry_statuses (Iterable): statuses worth retrying.
+    """
+
+    IDEMPOTENT_METHODS = frozenset(('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'))
+
+    def __init__(self, attempts=3, base_delay=0.2, max_delay=5,
+                 retry_statuses=(429, 500, 502, 503, 504)):
+        self.attempts = attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_statuses = frozenset(retry_statuses)
+
+    def should_retry(self, attempt, method='GET', status=None):
+        """Returns whether to retry after the attempt failed.
+
+        Args:
+            attempt (int): number of the failed attempt, from 1.
+            method (str): method of the request.
+            status (int, optional): status of the response, or None if
+                there was none.
+        """
+        if attempt >= self.attempts or method.upper() not in self.IDEMPOTENT_METHODS:
+            return False
+        return status is None or status in self.retry_statuses
+
+    def delay(self, attempt):
+        """Returns the seconds to wait after the attempt failed."""
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def __repr__(self):
+        return (f'RetryPolicy(attempts={self.attempts},'
+                f' base_delay={self.base_delay}, max_delay={self.max_delay})')
+
+
+class CircuitBreaker:
+    """Fails requests fast while the server keeps failing.
+
+    After ``threshold`` consecutive failures the circuit opens and
+    requests aren't made for ``reset_timeout`` seconds. Then one request is
+    let through: if it succeeds the circuit closes, otherwise it opens
+    again.
+
+    Args:
+        threshold (int): consecutive failures that open the circuit.
+        reset_timeout (float): seconds the circuit stays open.
+    """
+
+    def __init__(self, threshold=3, reset_timeout=30):
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened = None
+        self._trial = False
+        self._lock = threading.Lock()
+
+    @property
+    def state(self):
+        """'closed', 'open' or 'half_open'."""
+        if self.opened is None:
+            return 'closed'
+        if monotonic() - self.opened < self.reset_timeout:
+            return 'open'
+        return 'half_open'
+
+    def allow(self):
+        """Returns whether a request may be made now."""
+        with self._lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half_open' and not self._trial:
+                self._trial = True
+                return True
+            return False
+
+    def success(self):
+        with self._lock:
+            if self.opened is not None:
+                Logger.info('CIRCUIT: Closed.')
+            self.failures = 0
+            self.opened = None
+            self._trial = False
+
+    def failure(self):
+        with self._lock:
+            self.failures += 1
+            if self._trial or self.failures >= self.threshold:
+                if self.opened is None or self._trial:
+                    Logger.warning('CIRCUIT: Opened after %d failures.', self.failures)
+                self.opened = monotonic()
+                self._trial = False
+
+    def __repr__(self):
+        return f'CircuitBreaker(state={self.state!r}, failures={self.failures})'
 
 
 class Sender:
-    """Sends HTTP requests."""
+    """Sends HTTP requests.
+
+    Responses of the endpoints in CACHE_TTLS are kept in ``cache``, if it's
+    set. Requests for them are answered from the cache for as long as the
+    endpoint's TTL, after that they're made conditional on the cached
+    response, and if they fail the cached response is used anyway.
+
+    Failed requests are retried according to the endpoint's policy in
+    RETRY_POLICIES, or ``retries`` times ``sleep_time`` apart (before
+    jitter and backoff) for other endpoints. Requests to the same host
+    share a circuit breaker, so they fail right away while that host is
+    down without affecting requests to other hosts.
+
+    All requests go through one keep-alive session. Requests with a
+    trigger run on a pool of ``workers`` threads and report back on the
+    main thread, so back-to-back requests reuse the pool's connections
+    instead of setting up TCP and TLS again; see :meth:`connection_stats`.
+    """
     # Create a persistent requests connection
     API_ROOT = 'https://geniust-recommender.herokuapp.com/'
     AUTH_HEADER = {
@@ -61,14 +230,32 @@ class Sender:
                           "XAiOiJkZWZhdWx0In0.IDXKFocZM4JpDzE3xsO-M-iCOk"
                           "4LhAZjr7IxR0OJz4U")
     }
+    # Seconds that the responses of each endpoint are used without asking
+    # the server again.
+    CACHE_TTLS = {
+        'genres': 7 * 24 * 3600,
+        'recommendations': 30 * 60,
+        'search/artists': 24 * 3600,
+    }
+    RETRY_POLICIES = {
+        # The next keystroke supersedes a search soon enough.
+        'search/artists': RetryPolicy(attempts=1),
+    }
 
     def __init__(
         self,
         timeout=5,
         sleep_time=0.2,
-        retries=0
+        retries=0,
+        cache=None,
+        workers=4,
     ):
         self.session = requests.Session()
+        adapter = HTTPAdapter(pool_maxsize=workers)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.executor = ThreadPoolExecutor(max_workers=workers,
+                                           thread_name_prefix='Sender')
         self.headers = {
             'application': 'GeniusT Music Player',
         }
@@ -76,6 +263,9 @@ class Sender:
         self.timeout = timeout
         self.sleep_time = sleep_time
         self.retries = retries
+        self.cache = cache
+        self.retry_policy = RetryPolicy(attempts=retries + 1, base_delay=sleep_time)
+        self.breakers = {}
 
     def make_request(
         self,
@@ -89,9 +279,14 @@ class Sender:
         timeout=None,
         raw=False,
         use_requests=False,
+        use_cache=True,
         **kwargs
     ):
-        """Makes a request to Genius."""
+        """Makes a request to Genius.
+
+        use_cache=False skips fresh cached responses, but still revalidates
+        and stores the response and falls back on the cache.
+        """
         if api:
             url = self.API_ROOT + path
             if "headers" in kwargs:
@@ -105,57 +300,163 @@ class Sender:
 
         params = params if params else {}
         use_requests = use_requests or trigger is None
+
+        cache_key = cached = None
+        ttl = self.CACHE_TTLS.get(path) if api and not raw else None
+        if self.cache is not None and ttl is not None:
+            cache_key = self.cache.key(url, params)
+            cached = self.cache.get(cache_key)
+            if (use_cache
+                    and cached is not None
+                    and time() - cached['stored'] < ttl):
+                Logger.debug('CACHE: Used fresh response for %s', cache_key)
+                if use_requests:
+                    return cached['body']
+                response = Response(trigger, context=kwargs, url=cache_key)
+                response.on_result(200, cached['body'])
+                return response
+            headers = dict(headers, **self.cache.validators(cached))
+
+        policy = self.RETRY_POLICIES.get(path, self.retry_policy)
+        timeout = timeout or self.timeout
+
+        def fetch():
+            return self._fetch(url, headers, params, method, policy, timeout,
+                               raw, cache_key, cached)
+
         if use_requests:
-            req = self.session.get(url, headers=headers, params=params)
-            response = req.content if raw else req.json()
-            Logger.debug("RESPONSE: %s - URL %s - Payload: %s",
-                         req.status_code,
-                         req.url,
-                         response if not raw else "Bytes")
+            return fetch()[1]
+
+        response = Response(trigger, context=kwargs, url=url)
+        if async_request:
+            response.future = self.executor.submit(self._run, fetch, response)
+        else:
+            try:
+                response.on_result(*fetch())
+            except Exception as e:
+                response.on_error(e)
+        return response
+
+    @staticmethod
+    def _run(fetch, response):
+        """Runs fetch on a pool thread and reports to response on the main thread."""
+        from kivy.clock import Clock
+
+        try:
+            result = fetch()
+        except Exception as e:
+            response.fetched = perf_counter()
+            error = e
+            Clock.schedule_once(lambda *args: response.on_error(error))
         else:
-            from kivy.network.urlrequest import UrlRequest
-
-            for key in list(params):
-                if params[key] is None:
-                    params.pop(key)
-            url_parse = parse.urlparse(url)
-            query = url_parse.query
-            url_dict = dict(parse.parse_qsl(query))
-            url_dict.update(params)
-            url_new_query = parse.urlencode(url_dict)
-            url_parse = url_parse._replace(query=url_new_query)
-            new_url = parse.urlunparse(url_parse)
-
-            # Make the request
-            if headers is not None:
-                req_headers = self.headers.copy()
-                req_headers.update(headers)
+            response.fetched = perf_counter()
+            Clock.schedule_once(lambda *args: response.on_result(*result))
+
+    def _fetch(self, url, headers, params, method, policy, timeout,
+               raw, cache_key, cached):
+        """Makes a request, using the cache as the class describes.
+
+        Returns:
+            tuple: status code, body, and whether the body is a cached one
+            used because the request failed.
+        """
+        try:
+            req = self._get(url, headers, params, method, policy, timeout)
+        except requests.RequestException as e:
+            if cached is None:
+                raise
+            Logger.warning('CACHE: Used cached response for %s. Reason: %s',
+                           cache_key, e)
+            return 200, cached['body'], True
+        status_code = req.status_code
+        if cached is not None and status_code == 304:
+            self.cache.refresh(cache_key, cached)
+            status_code, response = 200, cached['body']
+        elif cached is not None and status_code >= 500:
+            Logger.warning('CACHE: Used cached response for %s. Status: %s',
+                           cache_key, status_code)
+            return 200, cached['body'], True
+        else:
+            response = req.content if raw else req.json()
+            if cache_key is not None and status_code == 200:
+                self.cache.put(cache_key, response,
+                               req.headers.get('ETag'),
+                               req.headers.get('Last-Modified'))
+        Logger.debug("RESPONSE: %s - URL %s - Payload: %s",
+                     req.status_code,
+                     req.url,
+                     response if not raw else "Bytes")
+        return status_code, response, False
+
+    def breaker(self, url):
+        """Returns the circuit breaker of url's host."""
+        host = parse.urlparse(url).netloc
+        breaker = self.breakers.get(host)
+        if breaker is None:
+            breaker = self.breakers.setdefault(host, CircuitBreaker())
+        return breaker
+
+    def _get(self, url, headers, params, method, policy, timeout=None):
+        """Makes a request with the session, retrying it according to policy."""
+        breaker = self.breaker(url)
+        attempt = 0
+        while True:
+            attempt += 1
+            if not breaker.allow():
+                raise CircuitOpenError(f"Not requesting {url} while the server is down")
+            try:
+                req = self.session.request(method, url, headers=headers,
+                                           params=params, timeout=timeout)
+            except requests.RequestException as e:
+                breaker.failure()
+                if not policy.should_retry(attempt, method):
+                    raise
+                Logger.debug('RETRY: %s failed. Reason: %s', url, e)
             else:
-                req_headers = self.headers
-            req = UrlRequest(new_url,
-                             req_headers=req_headers,
-                             timeout=timeout or self.timeout,
-                             debug=True,
-                             verify=False,
-                             )
-            response = Response(req, trigger, context=kwargs)
-            response.is_finished = req.is_finished
-
-            # Enforce rate limiting
-            # time.sleep(self.sleep_time)
-
-            if not async_request:
-                req.wait()
+                if req.status_code < 500:
+                    breaker.success()
+                else:
+                    breaker.failure()
+                if not policy.should_retry(attempt, method, req.status_code):
+                    return req
+                Logger.debug('RETRY: %s failed with %s', url, req.status_code)
+            sleep(policy.delay(attempt))
 
-        return response
+    def connection_stats(self):
+        """Returns how well the session reuses connections.
+
+        Counts are of the hosts the session has open pools for.
+
+        Returns:
+            dict: ``requests`` made, ``connections`` opened, and
+            ``reused``, the share of requests made on an open connection.
+        """
+        made = opened = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in pools.keys():
+                try:
+                    pool = pools[key]
+                except KeyError:
+                    continue
+                made += pool.num_requests
+                opened += pool.num_connections
+        reused = 1 - opened / made if made else None
+        return dict(requests=made, connections=opened, reused=reused)
 
 
 class API():
-    def __init__(self):
+    def __init__(self, cache_path=None):
         timeout = 7
         retries = 2
         sleep_time = 0.2
         self.sender = Sender(sleep_time=sleep_time, timeout=timeout, retries=retries)
+        if cache_path is not None:
+            self.use_cache(cache_path)
+
+    def use_cache(self, path):
+        """Keeps API responses in path, see Sender."""
+        self.sender.cache = ResponseCache(path)
 
     def get_genres(
         self,
@@ -181,6 +482,7 @@ class API():
         trigger=None,
         async_request: bool = True,
         timeout=None,
+        use_cache=True,
     ) -> List[str]:
         params = {
             'genres': ','.join(genres),
@@ -194,11 +496,12 @@ class API():
             trigger=trigger,
             async_request=async_request,
             timeout=timeout,
+            use_cache=use_cache,
         )
         if isinstance(res, Response):
             return res
         else:
-            return [Song(**x) for x in res['recommendations']]
+            return [Song.shared(**x) for x in res['recommendations']]
 
     def search_artists(
         self,
@@ -214,7 +517,10 @@ class API():
             async_request=async_request
         )
 
-        return [x["name"] for x in res["hits"]]
+        if isinstance(res, Response):
+            return res
+        else:
+            return res['artists']
 
     def download_preview(
         self,
@@ -248,4 +554,7 @@ class API():
             api=False
         )
 
-        return res["preferences"]
+        if isinstance(res, Response):
+            return res
+        else:
+            return res["preferences"]
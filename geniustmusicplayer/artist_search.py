@@ -0,0 +1,163 @@
+"""Artist search that keeps up with the user's typing."""
+import logging
+from collections import OrderedDict, deque
+from time import perf_counter
+
+Logger = logging.getLogger('gtplayer')
+
+
+class ArtistSearch:
+    """Searches artists, answering from earlier results where it can.
+
+    Only the results of the latest query are delivered. A new search
+    supersedes the one in flight. If its request is still waiting for a
+    thread of the sender's pool it's cancelled; otherwise it runs to
+    completion and its response is dropped when it arrives.
+
+    Results are kept per query in an LRU cache. A query that extends a
+    cached one (``"metal"`` after ``"met"``) gets the cached results
+    filtered locally right away. If the cached query had fewer than
+    ``page_size`` results, the server returned all of its matches and the
+    filtered results are final; otherwise they're delivered as provisional
+    while the server is asked.
+
+    The time from :meth:`search` to the final results is recorded for the
+    last ``samples`` searches; see :meth:`timings`.
+
+    Args:
+        api (API): API to search with.
+        on_results (Callable): Called on the main thread with the query,
+            the artists and whether they're final.
+        on_error (Callable): Called on the main thread with the query when
+            the search failed.
+        cache_size (int): number of queries to keep results of.
+        page_size (int): most results the server returns for a query.
+        samples (int): number of searches to keep timings of.
+    """
+
+    def __init__(self, api, on_results, on_error,
+                 cache_size=64, page_size=20, samples=200):
+        self.api = api
+        self.on_results = on_results
+        self.on_error = on_error
+        self.cache_size = cache_size
+        self.page_size = page_size
+        self._cache = OrderedDict()
+        self._generation = 0
+        self._in_flight = None
+        self._response = None
+        self._timings = deque(maxlen=samples)
+        self.searches = 0
+        self.superseded = 0
+
+    @staticmethod
+    def normalize(query):
+        return ' '.join(query.lower().split())
+
+    @staticmethod
+    def filter(artists, query):
+        """Returns the artists whose name contains query."""
+        return [artist for artist in artists if query in artist.lower()]
+
+    def search(self, query):
+        """Searches for query, superseding the previous search."""
+        query = self.normalize(query)
+        started = perf_counter()
+        self.cancel()
+
+        artists = self._cache_get(query)
+        if artists is not None:
+            self._deliver(query, artists, started)
+            return
+
+        prefix = self._cached_prefix(query)
+        if prefix is not None:
+            prefix_artists = self._cache_get(prefix)
+            artists = self.filter(prefix_artists, query)
+            if len(prefix_artists) < self.page_size:
+                self._cache_put(query, artists)
+                self._deliver(query, artists, started)
+                return
+            self.on_results(query, artists, False)
+
+        self._request(query, started)
+
+    def cancel(self):
+        """Drops the results of the search in flight, if there's one."""
+        self._generation += 1
+        if self._in_flight is not None:
+            Logger.debug('SEARCH: %r was superseded.', self._in_flight)
+            self.superseded += 1
+            self._in_flight = None
+        if self._response is not None:
+            if self._response.future is not None:
+                self._response.future.cancel()
+            self._response = None
+
+    def _request(self, query, started):
+        from kivy.clock import Clock
+
+        generation = self._generation
+
+        def on_response(*args):
+            if generation != self._generation:
+                return
+            self._in_flight = self._response = None
+            if res.status_code != 200:
+                self.on_error(query)
+                return
+            artists = res.response['artists']
+            self._cache_put(query, artists)
+            self._deliver(query, artists, started)
+
+        res = self.api.search_artists(query, trigger=Clock.create_trigger(on_response))
+        self._in_flight = query
+        self._response = res
+
+    def _cached_prefix(self, query):
+        """Returns the longest cached query that query extends, or None."""
+        for end in range(len(query) - 1, 0, -1):
+            if query[:end] in self._cache:
+                return query[:end]
+        return None
+
+    def _cache_get(self, query):
+        artists = self._cache.get(query)
+        if artists is not None:
+            self._cache.move_to_end(query)
+        return artists
+
+    def _cache_put(self, query, artists):
+        self._cache[query] = artists
+        self._cache.move_to_end(query)
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def _deliver(self, query, artists, started):
+        elapsed = perf_counter() - started
+        self._timings.append(elapsed)
+        self.searches += 1
+        Logger.debug('SEARCH: %d results for %r in %.0f ms.',
+                     len(artists), query, elapsed * 1000)
+        if self.searches % 20 == 0:
+            timings = self.timings()
+            Logger.debug('SEARCH: p50 %.0f ms, p95 %.0f ms, %d superseded.',
+                         timings['p50'] * 1000, timings['p95'] * 1000,
+                         self.superseded)
+        self.on_results(query, artists, True)
+
+    def timings(self):
+        """Returns the median and 95th percentile of the time to results.
+
+        Returns:
+            dict: ``count`` of searches, and ``p50`` and ``p95`` in seconds
+            (None if there were no searches).
+        """
+        timings = sorted(self._timings)
+        if not timings:
+            return dict(count=0, p50=None, p95=None)
+
+        def percentile(p):
+            return timings[min(len(timings) - 1, int(p * len(timings)))]
+
+        return dict(count=len(timings), p50=percentile(.5), p95=percentile(.95))
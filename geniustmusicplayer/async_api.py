@@ -0,0 +1,120 @@
+"""asyncio counterpart of api.API."""
+import asyncio
+import functools
+import logging
+import weakref
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List
+
+from api import API
+from utils import Song
+
+Logger = logging.getLogger('gtplayer')
+
+
+class AsyncAPI:
+    """API with coroutines instead of triggers.
+
+    Requests are made by the API's synchronous methods on a thread pool of
+    ``limit`` threads, so they share the sender's connections, response
+    cache, retries and circuit breakers with the trigger-based API without
+    taking threads from its pool. At most ``limit`` of them run at once in
+    each event loop, and each is given up on after ``timeout`` seconds.
+
+    Cancelling a request, or its timing out, stops waiting for it, but
+    ``requests`` can't interrupt a request that's been sent, so it keeps
+    its thread until it's done.
+
+    Requests that don't depend on each other can be made together::
+
+        api = AsyncAPI(app.api)
+        genres, tracks = await asyncio.gather(
+            api.get_genres(age=age),
+            api.get_recommendations(app.genres, app.artists),
+        )
+
+    This works in any running asyncio loop, such as the one of an app
+    started with ``app.async_run(async_lib='asyncio')``.
+
+    Args:
+        api (API, optional): API to make the requests with. A new one is
+            created if it's missing.
+        limit (int): most requests running at once.
+        timeout (float): seconds a request may take, retries included.
+    """
+
+    def __init__(self, api: Optional[API] = None, limit=4, timeout=30):
+        self.api = api if api is not None else API()
+        self.limit = limit
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=limit,
+                                           thread_name_prefix='AsyncAPI')
+        # A semaphore only works in the loop it was first used in.
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def _semaphore(self, loop):
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.limit)
+        return semaphore
+
+    async def _call(self, method, *args, timeout=None, **kwargs):
+        loop = asyncio.get_running_loop()
+        call = functools.partial(method, *args, async_request=False, **kwargs)
+        async with self._semaphore(loop):
+            future = loop.run_in_executor(self.executor, call)
+            try:
+                return await asyncio.wait_for(future, timeout or self.timeout)
+            except asyncio.TimeoutError:
+                Logger.error('AsyncAPI: %s timed out.', method.__name__)
+                raise
+
+    async def get_genres(
+        self,
+        age: Optional[int] = None,
+        timeout=None,
+    ) -> List[str]:
+        return await self._call(self.api.get_genres, age, timeout=timeout)
+
+    async def get_recommendations(
+        self,
+        genres: List[str],
+        artists: Optional[List[str]] = None,
+        song_type='any_file',
+        timeout=None,
+        use_cache=True,
+    ) -> List[Song]:
+        return await self._call(
+            self.api.get_recommendations,
+            genres,
+            artists,
+            song_type=song_type,
+            use_cache=use_cache,
+            timeout=timeout,
+        )
+
+    async def search_artists(
+        self,
+        artist: str,
+        timeout=None,
+    ) -> List[str]:
+        return await self._call(self.api.search_artists, artist, timeout=timeout)
+
+    async def download_preview(
+        self,
+        song: Song,
+        timeout=None,
+    ) -> bytes:
+        return await self._call(self.api.download_preview, song, timeout=timeout)
+
+    async def get_preferences(
+        self,
+        code: str,
+        platform: str,
+        timeout=None,
+    ) -> dict:
+        return await self._call(self.api.get_preferences, code, platform,
+                                timeout=timeout)
+
+    def __repr__(self):
+        return f'AsyncAPI(limit={self.limit}, timeout={self.timeout})'
@@ -0,0 +1,191 @@
+"""Export and import of the user's library as JSON lines.
+
+A backup has one JSON object per line. The first line holds the user's
+preferences, followed by the favorites in the order they were favorited
+and the playlist in order::
+
+    {"type": "user", "genres": [...], "artists": [...], "volume": 0.5, ...}
+    {"type": "favorite", "track": {"id": 1, "name": ...}, "date_favorited": ...}
+    {"type": "playlist", "track": {"id": 2, "name": ...}, "current": true}
+
+Both directions stream: rows are written to the file as they are read
+from the database, and lines are read from the file in batches that are
+written with ``executemany``, so memory use doesn't grow with the size of
+the library.
+"""
+import json
+import logging
+from collections import Counter
+from contextlib import closing
+from itertools import chain, islice
+
+from db import Database, POSITION_STEP
+from utils import Playlist
+
+# Number of backup lines written to the database per executemany.
+BATCH_SIZE = 1000
+
+USER_FIELDS = ('dark_mode', 'play_mode', 'songs_path', 'volume', 'last_pos')
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def _track_record(row):
+    return dict(zip(Database.track_columns, row))
+
+
+def _export_records(db, cursor):
+    """Yields the backup's records, reading the rows as they're needed."""
+    user = db.get_user()
+    if user is None:
+        raise ValueError("There's no user to export")
+    yield dict(type='user', **user)
+
+    columns = ", ".join(f't.{column}' for column in Database.track_columns)
+    fields = len(Database.track_columns)
+    cursor.execute(f"""SELECT {columns}, f.date_favorited
+                       FROM favorites f
+                       JOIN tracks t ON t.id = f.track_id
+                       ORDER BY f.date_favorited, f.track_id;""")
+    for row in cursor:
+        yield dict(type='favorite',
+                   track=_track_record(row[:fields]),
+                   date_favorited=row[fields])
+
+    cursor.execute(f"""SELECT {columns}, p.current
+                       FROM playlist p
+                       JOIN tracks t ON t.id = p.track_id
+                       ORDER BY p.position;""")
+    for row in cursor:
+        yield dict(type='playlist',
+                   track=_track_record(row[:fields]),
+                   current=bool(row[fields]))
+
+
+def export_library(db, path):
+    """Writes the user's preferences, favorites and playlist to path.
+
+    The rows are read in one read transaction, so the backup is consistent
+    even if the other process writes to the database meanwhile.
+
+    Args:
+        db (Database): database to export.
+        path (str): path of the backup file.
+
+    Returns:
+        Counter: number of exported records of each type.
+    """
+    counts = Counter()
+    con = db.connections.connection()
+    con.execute('BEGIN;')
+    try:
+        with closing(con.cursor()) as cursor, open(path, 'w') as f:
+            for record in _export_records(db, cursor):
+                f.write(json.dumps(record))
+                f.write('\n')
+                counts[record['type']] += 1
+    finally:
+        con.execute('COMMIT;')
+    logging.debug('BACKUP: Exported %s to %s', dict(counts), path)
+    return counts
+
+
+def _import_user(db, record, cursor):
+    db.update_genres(record['genres'])
+    db.update_artists(record['artists'])
+    assignments = ", ".join(f'{field} = ?' for field in USER_FIELDS)
+    cursor.execute(f"UPDATE user SET {assignments};",
+                   [record[field] for field in USER_FIELDS])
+
+
+def _import_tracks(tracks, cursor):
+    """Saves the tracks of a batch, keeping file paths like _save_tracks."""
+    update = """UPDATE tracks SET name = ?, artist = ?, id_spotify = ?,
+                       isrc = ?, cover_art = ?, preview_url = ?,
+                       download_url = ?,
+                       preview_file = COALESCE(?, preview_file),
+                       download_file = COALESCE(?, download_file),
+                       genres = ?
+                WHERE id = ?;"""
+    insert = """INSERT OR IGNORE INTO tracks VALUES (?,?,?,?,?,?,?,?,?,?,?);"""
+    # Backups from before tracks had genres don't have the column.
+    rows = [[track.get(column) for column in Database.track_columns]
+            for track in tracks]
+    cursor.executemany(update, (row[1:] + row[:1] for row in rows))
+    cursor.executemany(insert, rows)
+
+
+def _import_records(db, records, batch_size, cursor, counts):
+    """Writes the records in batches, counting them by type in counts."""
+    position = 0
+    for batch in _batches(records, batch_size):
+        favorites, playlist = [], []
+        for record in batch:
+            if record['type'] == 'user':
+                _import_user(db, record, cursor)
+            elif record['type'] == 'favorite':
+                favorites.append(record)
+            elif record['type'] == 'playlist':
+                playlist.append(record)
+            else:
+                logging.warning('BACKUP: Skipped unknown record %r', record['type'])
+                continue
+            counts[record['type']] += 1
+        _import_tracks((record['track'] for record in favorites + playlist), cursor)
+        cursor.executemany(
+            "INSERT OR REPLACE INTO favorites VALUES (?,?);",
+            ((record['track']['id'], record['date_favorited'])
+             for record in favorites),
+        )
+        cursor.executemany(
+            "INSERT OR REPLACE INTO playlist VALUES (?,?,?);",
+            ((record['track']['id'], record['current'],
+              (position + i) * POSITION_STEP)
+             for i, record in enumerate(playlist)),
+        )
+        position += len(playlist)
+
+
+def import_library(db, path, batch_size=BATCH_SIZE):
+    """Replaces the user's library with the backup at path.
+
+    Everything is imported in one transaction, so a backup that fails
+    halfway leaves the library as it was. The search index is rebuilt once
+    at the end rather than updated for every track.
+
+    Args:
+        db (Database): database to import into.
+        path (str): path of a backup written by :func:`export_library`.
+        batch_size (int): number of lines written per executemany.
+
+    Returns:
+        Counter: number of imported records of each type.
+
+    Raises:
+        ValueError: if the backup is empty, or if the database has no user
+            and the backup doesn't start with one.
+    """
+    counts = Counter()
+    with open(path) as f, db.transaction() as con, closing(con.cursor()) as cursor:
+        records = (json.loads(line) for line in f if line.strip())
+        first = next(records, None)
+        if first is None:
+            raise ValueError("The backup is empty")
+        if db.get_user() is not None:
+            cursor.execute("DELETE FROM favorites;")
+            cursor.execute("DELETE FROM playlist;")
+        elif first['type'] == 'user':
+            db.initialize(first['genres'], first['artists'],
+                          first['songs_path'], Playlist([]))
+        else:
+            raise ValueError("The backup doesn't start with a user")
+
+        with db.bulk_load():
+            _import_records(db, chain([first], records), batch_size, cursor, counts)
+        db._prune_tracks(cursor=cursor)
+    logging.debug('BACKUP: Imported %s from %s', dict(counts), path)
+    return counts
@@ -0,0 +1,328 @@
+"""Caches of downloaded audio files and API responses."""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+from time import time
+from urllib import parse
+
+Logger = logging.getLogger('gtplayer')
+
+# Bytes of API responses kept by ResponseCache.
+RESPONSE_CACHE_SIZE = 2 * 1024 * 1024
+
+
+def _write_atomic(path, data):
+    """Writes data to a temporary file and renames it to path."""
+    directory = os.path.dirname(path)
+    fd, temp_path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temp_path, path)
+    except BaseException:
+        os.remove(temp_path)
+        raise
+
+
+class AudioCache:
+    """Downloaded audio files, keyed by the track they're of.
+
+    A file's name is the SHA-1 of its key, the track's ISRC (or its id if it
+    has none) and whether it's a preview, and it's kept in a subdirectory
+    named after the first two characters of the hash, so no directory gets
+    too big and tracks with the same name can't overwrite each other.
+
+    Files are written to a temporary file that's renamed into place once
+    it's complete, so a crash mid-write never leaves a truncated file
+    behind. The manifest records the size and SHA-256 of every file, and
+    is rewritten the same way. Looking a track up only reads the manifest,
+    which is kept in memory, and stats the file.
+
+    Only one process should write to a cache directory.
+
+    Args:
+        root (str): directory of the cache. It's created if it's missing.
+    """
+
+    manifest_name = 'manifest.json'
+    suffix = '.mp3'
+
+    def __init__(self, root):
+        self.root = root
+        self.manifest_path = os.path.join(root, self.manifest_name)
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+        self.entries = self._load_manifest()
+
+    def _load_manifest(self):
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            Logger.error('CACHE: Unreadable manifest, starting over. Reason: %s', e)
+            return {}
+
+    def _save_manifest(self):
+        _write_atomic(self.manifest_path,
+                      json.dumps(self.entries, sort_keys=True).encode())
+
+    @staticmethod
+    def key(song, preview=True):
+        """Returns the cache key of the song's preview or full track."""
+        track = f'isrc:{song.isrc}' if song.isrc else f'id:{song.id}'
+        return f'{track}:{"preview" if preview else "full"}'
+
+    def path(self, key):
+        """Returns where the file of key is stored."""
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, digest[:2], digest + self.suffix)
+
+    def get(self, song, preview=True):
+        """Returns the path of the song's file, or None if it isn't cached.
+
+        Entries whose file is gone or has the wrong size are dropped.
+        """
+        key = self.key(song, preview)
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        path = self.path(key)
+        try:
+            size = os.stat(path).st_size
+        except FileNotFoundError:
+            size = None
+        if size != entry['size']:
+            Logger.warning('CACHE: Dropped %s, its file is missing or changed.', key)
+            self._forget(key)
+            return None
+        return path
+
+    def __contains__(self, song):
+        return self.get(song) is not None
+
+    def put(self, song, data, preview=True):
+        """Saves data as the song's file and returns its path."""
+        key = self.key(song, preview)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_atomic(path, data)
+        self._record(key, len(data), hashlib.sha256(data).hexdigest())
+        Logger.debug('CACHE: Saved %s (%d bytes)', key, len(data))
+        return path
+
+    def adopt(self, song, file, preview=True):
+        """Moves an existing file into the cache and returns its new path.
+
+        Used for files downloaded before the cache existed.
+        """
+        key = self.key(song, preview)
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(file, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        os.replace(file, path)
+        self._record(key, os.stat(path).st_size, checksum)
+        return path
+
+    def _record(self, key, size, checksum):
+        with self._lock:
+            self.entries[key] = dict(size=size, sha256=checksum, added=time())
+            self._save_manifest()
+
+    def _forget(self, key):
+        with self._lock:
+            if self.entries.pop(key, None) is not None:
+                self._save_manifest()
+
+    def remove(self, song, preview=True):
+        """Deletes the song's file if it's cached."""
+        key = self.key(song, preview)
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+        self._forget(key)
+
+    def verify(self, song, preview=True):
+        """Returns whether the song's file matches its recorded checksum."""
+        path = self.get(song, preview)
+        if path is None:
+            return False
+        with open(path, 'rb') as f:
+            checksum = hashlib.sha256(f.read()).hexdigest()
+        return checksum == self.entries[self.key(song, preview)]['sha256']
+
+    def clean(self):
+        """Deletes leftover temporary files and files missing from the manifest.
+
+        Files directly in the root directory are left alone; they're from
+        before the cache and are moved in by :meth:`adopt`.
+
+        Returns:
+            int: number of deleted files.
+        """
+        known = {self.path(key) for key in self.entries}
+        removed = 0
+        for directory, _, files in os.walk(self.root):
+            for name in files:
+                path = os.path.join(directory, name)
+                if path == self.manifest_path:
+                    continue
+                if (name.endswith('.tmp')
+                        or (directory != self.root and path not in known)):
+                    os.remove(path)
+                    removed += 1
+        Logger.debug('CACHE: Cleaned %d files.', removed)
+        return removed
+
+    @property
+    def size(self):
+        """Total size of the cached files in bytes."""
+        return sum(entry['size'] for entry in self.entries.values())
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __repr__(self):
+        return f'AudioCache({self.root!r}, {len(self.entries)} files)'
+
+
+class ResponseCache:
+    """API responses kept on disk.
+
+    Every response is a JSON file named after the SHA-1 of its key, holding
+    the response's body, when it was stored and the validators the server
+    sent with it (``ETag`` and ``Last-Modified``). Files are written
+    atomically and there's no shared index, so the app and the service can
+    use the same directory.
+
+    Reading a response touches its file, and once the files take up more
+    than ``max_size`` bytes the least recently read ones are deleted.
+
+    Whether a response is fresh enough to use is up to the caller; the
+    cache keeps stale responses to revalidate or to fall back on offline.
+
+    Args:
+        root (str): directory of the cache. It's created if it's missing.
+        max_size (int): bytes the responses may take up.
+    """
+
+    suffix = '.json'
+
+    def __init__(self, root, max_size=RESPONSE_CACHE_SIZE):
+        self.root = root
+        self.max_size = max_size
+        os.makedirs(root, exist_ok=True)
+
+    @staticmethod
+    def key(url, params=None):
+        """Returns the key of a GET request.
+
+        The query of the URL and the params are merged, parameters that are
+        None are dropped and the rest are sorted, so the same request gets
+        the same key however its parameters were given.
+        """
+        url_parse = parse.urlparse(url)
+        query = dict(parse.parse_qsl(url_parse.query))
+        if params:
+            query.update((k, str(v)) for k, v in params.items() if v is not None)
+        query = parse.urlencode(sorted(query.items()))
+        return parse.urlunparse(url_parse._replace(query=query))
+
+    def path(self, key):
+        """Returns where the response of key is stored."""
+        digest = hashlib.sha1(key.encode()).hexdigest()
+        return os.path.join(self.root, digest + self.suffix)
+
+    def get(self, key):
+        """Returns the entry of key, or None if there's none.
+
+        The entry is a dict with the ``body``, the time it was ``stored``
+        at, and its ``etag`` and ``last_modified`` (either may be None).
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                entry = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            Logger.warning('CACHE: Dropped unreadable response %s. Reason: %s', key, e)
+            self.remove(key)
+            return None
+        if entry.get('key') != key:
+            return None
+        return entry
+
+    def put(self, key, body, etag=None, last_modified=None):
+        """Stores body as the response of key and returns its entry."""
+        entry = dict(key=key, body=body, stored=time(),
+                     etag=etag, last_modified=last_modified)
+        _write_atomic(self.path(key), json.dumps(entry).encode())
+        self.evict()
+        return entry
+
+    def refresh(self, key, entry):
+        """Marks entry as stored now, when the server says it's unchanged."""
+        return self.put(key, entry['body'], entry['etag'], entry['last_modified'])
+
+    @staticmethod
+    def validators(entry):
+        """Returns the headers that make a request conditional on entry."""
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def remove(self, key):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self):
+        """Deletes the least recently read responses until they fit in max_size.
+
+        Returns:
+            int: number of deleted responses.
+        """
+        files = []
+        size = 0
+        with os.scandir(self.root) as entries:
+            for entry in entries:
+                if not entry.name.endswith(self.suffix):
+                    continue
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, entry.path))
+                size += stat.st_size
+        removed = 0
+        for _, file_size, path in sorted(files):
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+            removed += 1
+        if removed:
+            Logger.debug('CACHE: Evicted %d responses.', removed)
+        return removed
+
+    def __repr__(self):
+        return f'ResponseCache({self.root!r}, max_size={self.max_size})'
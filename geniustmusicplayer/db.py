@@ -1,41 +1,586 @@
+import os
 import sqlite3
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from functools import wraps
-from contextlib import closing
+from datetime import date
+from time import perf_counter, time
+from contextlib import closing, contextmanager
 from typing import Any, TypeVar, Callable, Optional, Tuple
 
-from utils import Song, Playlist
+from utils import Song, Playlist, Favorites, log
 
 RT = TypeVar("RT")
 
+# Gap between the positions of neighbouring playlist tracks. Tracks inserted
+# between two others get the midpoint, so a full rewrite is only needed
+# once a gap can no longer be halved.
+POSITION_STEP = 1024.0
+
+sqlite3.register_adapter(bool, int)
+sqlite3.register_converter("BOOLEAN", lambda v: bool(int(v)))
+
+# One writer lock per database file, shared by every manager in the process.
+_write_locks = {}
+_write_locks_lock = threading.Lock()
+
+
+def _get_write_lock(path: str) -> threading.RLock:
+    key = os.path.abspath(path)
+    with _write_locks_lock:
+        return _write_locks.setdefault(key, threading.RLock())
+
+
+class ConnectionManager:
+    """Keeps one long-lived connection per thread.
+
+    Connections are opened lazily the first time a thread asks for one
+    and are reused for every later call from that thread. They keep
+    sqlite3's same-thread check, so a connection used from a thread other
+    than its own raises :class:`sqlite3.ProgrammingError`. For the same
+    reason a connection is only ever closed by its own thread, or dropped
+    once its thread has exited.
+
+    The database is journaled in WAL mode so that the activity and the
+    service can read while the other one writes. Writes go through
+    :meth:`transaction`, which serializes the writers of this process and
+    relies on the busy timeout to wait for a writer in the other process.
+    """
+
+    def __init__(self, path: str = 'user.db', busy_timeout: float = 10):
+        self.path = path
+        self.busy_timeout = busy_timeout
+        self.write_lock = _get_write_lock(path)
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._generation = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(
+            self.path,
+            timeout=self.busy_timeout,
+            isolation_level=None,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+        )
+        con.execute('PRAGMA journal_mode=WAL;')
+        con.execute('PRAGMA synchronous=NORMAL;')
+        return con
+
+    def connection(self) -> sqlite3.Connection:
+        """Returns the connection owned by the calling thread."""
+        local = self._local
+        if getattr(local, 'generation', None) == self._generation:
+            return local.connection
+        if getattr(local, 'depth', 0):
+            # Retired by close_all() during a transaction, which keeps its
+            # connection until it's done.
+            return local.connection
+        if getattr(local, 'generation', None) is not None:
+            local.connection.close()
+
+        thread = threading.current_thread()
+        con = self._connect()
+        with self._lock:
+            self._prune()
+            self._connections[thread.ident] = (thread, con)
+            local.connection = con
+            local.generation = self._generation
+        logging.debug('DB: Opened connection for thread %s', thread.name)
+        return con
+
+    def _prune(self) -> None:
+        """Drops connections of threads that have exited.
+
+        Only the owning thread may close a connection, so they're closed
+        when they're garbage collected.
+        """
+        for ident, (thread, con) in list(self._connections.items()):
+            if not thread.is_alive():
+                del self._connections[ident]
+
+    @contextmanager
+    def transaction(self):
+        """Runs the enclosed statements in a single write transaction.
+
+        Nested transactions join the outermost one, so a batch of writes is
+        committed once when the outermost block exits, or rolled back if it
+        raises.
+        """
+        local = self._local
+        con = self.connection()
+        with self.write_lock:
+            if getattr(local, 'depth', 0):
+                local.depth += 1
+                try:
+                    yield con
+                finally:
+                    local.depth -= 1
+                return
+
+            con.execute('BEGIN IMMEDIATE;')
+            local.depth = 1
+            try:
+                yield con
+            except BaseException:
+                con.execute('ROLLBACK;')
+                raise
+            else:
+                con.execute('COMMIT;')
+            finally:
+                local.depth = 0
+
+    def release(self) -> None:
+        """Closes the calling thread's connection."""
+        with self._lock:
+            entry = self._connections.pop(threading.get_ident(), None)
+            self._local.generation = None
+        if entry is not None:
+            entry[1].close()
+
+    def close_all(self) -> None:
+        """Closes the calling thread's connection and retires the others.
+
+        Connections of threads that have exited are dropped. Threads that
+        are still running close theirs the next time they use the database,
+        once any transaction they're in has finished, and get a new one.
+        """
+        self.release()
+        with self._lock:
+            self._prune()
+            self._generation += 1
+
 
 def get_cursor(func: Callable[..., RT]) -> Callable[..., RT]:
     """Returns a DB cursor for the wrapped functions"""
 
     @wraps(func)
     def wrapper(self, *args, **kwargs) -> RT:
-        sqlite3.register_adapter(bool, int)
-        sqlite3.register_converter("BOOLEAN", lambda v: bool(int(v)))
-        con = sqlite3.connect(
-            'user.db',
-            isolation_level=None,
-            detect_types=sqlite3.PARSE_DECLTYPES
-        )
+        con = self.connections.connection()
         with closing(con.cursor()) as cursor:
             return func(self, *args, **kwargs, cursor=cursor)
 
-    return wrapper
+    return log(wrapper)
+
+
+def write_cursor(func: Callable[..., RT]) -> Callable[..., RT]:
+    """Returns a DB cursor inside a write transaction for the wrapped functions"""
+
+    @wraps(func)
+    def wrapper(self, *args, **kwargs) -> RT:
+        with self.connections.transaction() as con:
+            with closing(con.cursor()) as cursor:
+                return func(self, *args, **kwargs, cursor=cursor)
+
+    return log(wrapper)
+
+
+def _table_columns(cursor, table):
+    cursor.execute(f"PRAGMA table_info({table});")
+    return [row[1] for row in cursor.fetchall()]
+
+
+def _add_playlist_positions(cursor):
+    """Orders the playlist by a position column instead of the rowid."""
+    columns = _table_columns(cursor, 'playlist')
+    if 'position' in columns or 'track_id' in columns:
+        return
+    cursor.execute("ALTER TABLE playlist ADD COLUMN position real;")
+    cursor.execute(f"UPDATE playlist SET position = rowid * {POSITION_STEP};")
+    cursor.execute("CREATE INDEX playlist_position ON playlist (position)")
+    cursor.execute("CREATE INDEX playlist_current ON playlist (current)")
+
+
+def _move_tracks_to_table(cursor):
+    """Moves the metadata of playlist and favorites tracks to a tracks table."""
+    if 'track_id' in _table_columns(cursor, 'playlist'):
+        return
+    fields = ("id, name, artist, id_spotify, isrc, cover_art, preview_url,"
+              " download_url, preview_file, download_file")
+    for table in ('playlist', 'favorites'):
+        cursor.execute(f"ALTER TABLE {table} RENAME TO old_{table};")
+    for index in ('playlist_position', 'playlist_current'):
+        cursor.execute(f"DROP INDEX IF EXISTS {index};")
+
+    cursor.execute('''CREATE TABLE tracks
+                 (id integer PRIMARY KEY,
+                  name TEXT,
+                  artist TEXT,
+                  id_spotify TEXT,
+                  isrc TEXT,
+                  cover_art TEXT,
+                  preview_url TEXT,
+                  download_url TEXT,
+                  preview_file TEXT,
+                  download_file TEXT)
+             ''')
+    cursor.execute('''CREATE INDEX tracks_id_spotify ON tracks (id_spotify)''')
+    cursor.execute('''CREATE INDEX tracks_isrc ON tracks (isrc)''')
+    cursor.execute('''CREATE TABLE favorites
+                 (track_id integer PRIMARY KEY REFERENCES tracks (id),
+                  date_favorited real)
+             ''')
+    cursor.execute('''CREATE INDEX favorites_date ON favorites (date_favorited)''')
+    cursor.execute('''CREATE TABLE playlist
+                 (track_id integer PRIMARY KEY REFERENCES tracks (id),
+                  current boolean DEFAULT 0,
+                  position real NOT NULL)
+             ''')
+    cursor.execute('''CREATE INDEX playlist_position ON playlist (position)''')
+    cursor.execute('''CREATE INDEX playlist_current ON playlist (current)''')
+
+    for table in ('playlist', 'favorites'):
+        cursor.execute(f"""INSERT OR IGNORE INTO tracks
+                           SELECT {fields} FROM old_{table};""")
+    cursor.execute("""INSERT INTO playlist
+                      SELECT id, current, position FROM old_playlist;""")
+    cursor.execute("""INSERT INTO favorites
+                      SELECT id, date_favorited FROM old_favorites;""")
+    for table in ('playlist', 'favorites'):
+        cursor.execute(f"DROP TABLE old_{table};")
+
+
+def _add_track_sort_indexes(cursor):
+    """Indexes track names and artists for sorting favorites."""
+    cursor.execute('''CREATE INDEX tracks_name ON tracks (name)''')
+    cursor.execute('''CREATE INDEX tracks_artist ON tracks (artist)''')
+
+
+def _create_library_search(cursor):
+    """Creates the full-text index of track names and artists.
+
+    The index reads its content from the tracks table and is kept in sync
+    with it by triggers. Builds of SQLite without FTS5 go without it and
+    searches fall back to LIKE.
+    """
+    try:
+        cursor.execute('''CREATE VIRTUAL TABLE tracks_search USING fts5
+                     (name, artist, content='tracks', content_rowid='id',
+                      prefix='1 2 3')
+                 ''')
+    except sqlite3.OperationalError as e:
+        logging.warning('DB: Full-text search is unavailable: %s', e)
+        return
+    _create_library_search_triggers(cursor)
+
+
+def _create_library_search_triggers(cursor):
+    cursor.execute('''CREATE TRIGGER tracks_search_insert AFTER INSERT ON tracks
+                 BEGIN
+                     INSERT INTO tracks_search (rowid, name, artist)
+                     VALUES (new.id, new.name, new.artist);
+                 END
+             ''')
+    cursor.execute('''CREATE TRIGGER tracks_search_delete AFTER DELETE ON tracks
+                 BEGIN
+                     INSERT INTO tracks_search (tracks_search, rowid, name, artist)
+                     VALUES ('delete', old.id, old.name, old.artist);
+                 END
+             ''')
+    cursor.execute('''CREATE TRIGGER tracks_search_update
+                 AFTER UPDATE OF name, artist ON tracks
+                 BEGIN
+                     INSERT INTO tracks_search (tracks_search, rowid, name, artist)
+                     VALUES ('delete', old.id, old.name, old.artist);
+                     INSERT INTO tracks_search (rowid, name, artist)
+                     VALUES (new.id, new.name, new.artist);
+                 END
+             ''')
+
+
+def _drop_library_search_triggers(cursor):
+    for trigger in ('insert', 'delete', 'update'):
+        cursor.execute(f"DROP TRIGGER IF EXISTS tracks_search_{trigger};")
+
+
+def _add_library_search(cursor):
+    """Indexes the saved tracks for full-text search."""
+    _create_library_search(cursor)
+    if _table_columns(cursor, 'tracks_search'):
+        cursor.execute("INSERT INTO tracks_search (tracks_search) VALUES ('rebuild');")
+
+
+# Number of entries kept in the change log. Callers that are further
+# behind than that reload instead of applying the changes.
+CHANGE_LOG_SIZE = 500
+
+
+def _create_change_log(cursor):
+    """Creates the log of changes to the playlist, favorites and tracks.
+
+    Triggers add an entry for every changed row and drop the oldest entries
+    once the log is full. An entry's version only ever grows, so callers can
+    ask for everything that changed after the last version they've seen.
+    The log is kept when the user is deleted, so versions keep growing
+    across resets; only the triggers are created again.
+    """
+    cursor.execute('''CREATE TABLE IF NOT EXISTS changes
+                 (version integer PRIMARY KEY AUTOINCREMENT,
+                  table_name TEXT NOT NULL,
+                  track_id integer NOT NULL)
+             ''')
+    cursor.execute(f'''CREATE TRIGGER IF NOT EXISTS changes_prune
+                 AFTER INSERT ON changes
+                 BEGIN
+                     DELETE FROM changes
+                     WHERE version <= new.version - {CHANGE_LOG_SIZE};
+                 END
+             ''')
+    for table, operations in (('playlist', ('INSERT', 'UPDATE', 'DELETE')),
+                              ('favorites', ('INSERT', 'UPDATE', 'DELETE')),
+                              ('tracks', ('UPDATE',))):
+        for operation in operations:
+            row = 'old' if operation == 'DELETE' else 'new'
+            track_id = 'id' if table == 'tracks' else 'track_id'
+            cursor.execute(f'''CREATE TRIGGER {table}_{operation.lower()}_change
+                         AFTER {operation} ON {table}
+                         BEGIN
+                             INSERT INTO changes (table_name, track_id)
+                             VALUES ('{table}', {row}.{track_id});
+                         END
+                     ''')
+
+
+def _add_change_log(cursor):
+    """Logs changes so readers can skip reloading unchanged data."""
+    _create_change_log(cursor)
+
+
+def _create_history(cursor):
+    """Creates the log of play events and the play counts rolled up from it.
+
+    play_counts has a row per track, artist and genre for every day it was
+    played on, keyed by the day's ordinal, and a row for day 0 that holds
+    the all-time counts. Its rows are updated as events are written, so
+    reading them never scans the history.
+    """
+    cursor.execute('''CREATE TABLE history
+                 (id integer PRIMARY KEY,
+                  track_id integer NOT NULL REFERENCES tracks (id),
+                  event TEXT NOT NULL
+                    CHECK(event in ('play', 'skip', 'complete')),
+                  date real NOT NULL,
+                  position real)
+             ''')
+    cursor.execute('''CREATE INDEX history_track ON history (track_id)''')
+    cursor.execute('''CREATE TABLE play_counts
+                 (kind TEXT NOT NULL CHECK(kind in ('track', 'artist', 'genre')),
+                  key TEXT NOT NULL,
+                  day integer NOT NULL,
+                  plays integer NOT NULL DEFAULT 0,
+                  skips integer NOT NULL DEFAULT 0,
+                  completes integer NOT NULL DEFAULT 0,
+                  last_played real,
+                  PRIMARY KEY (kind, key, day))
+             ''')
+    cursor.execute('''CREATE INDEX play_counts_plays
+                 ON play_counts (kind, day, plays)''')
+    cursor.execute('''CREATE INDEX play_counts_last_played
+                 ON play_counts (kind, day, last_played)''')
+
+
+def _add_history(cursor):
+    """Saves the genres of tracks and starts the listening history."""
+    if 'genres' not in _table_columns(cursor, 'tracks'):
+        cursor.execute("ALTER TABLE tracks ADD COLUMN genres TEXT;")
+    _create_history(cursor)
+
+
+# Schema migrations in the order they're applied. A database's
+# PRAGMA user_version is the number of migrations it has gone through.
+# Migrations create tables with the layout of their own version, not the
+# latest one, since later migrations build on top of them.
+MIGRATIONS = (
+    _add_playlist_positions,
+    _move_tracks_to_table,
+    _add_track_sort_indexes,
+    _add_library_search,
+    _add_change_log,
+    _add_history,
+)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+class DatabaseWorker:
+    """Runs database calls on a background thread.
+
+    The UI thread submits calls instead of making them, so slow storage
+    doesn't drop frames. Calls run one after another in the order they
+    were submitted and their results are delivered back on the UI thread.
+
+    Args:
+        schedule (Callable, optional): Schedules a function on the thread
+            that should receive results. Defaults to Kivy's
+            ``Clock.schedule_once``.
+    """
+
+    def __init__(self, schedule=None):
+        self.schedule = schedule
+        self._executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix='db-worker',
+        )
+
+    def submit(self, func, *args, callback=None, on_error=None, **kwargs):
+        """Runs func(*args, **kwargs) on the worker thread.
+
+        Args:
+            func (Callable): the call to make, usually a Database method.
+            callback (Callable, optional): Called with the result on the
+                UI thread.
+            on_error (Callable, optional): Called with the exception on the
+                UI thread if the call raises. Errors are logged otherwise.
+
+        Returns:
+            concurrent.futures.Future: the future of the call.
+        """
+        future = self._executor.submit(func, *args, **kwargs)
+
+        def deliver(*args):
+            error = future.exception()
+            if error is not None:
+                if on_error is not None:
+                    on_error(error)
+                else:
+                    logging.error('DB: %s failed: %s',
+                                  getattr(func, '__name__', func), error)
+            elif callback is not None:
+                callback(future.result())
+
+        schedule = self.schedule
+        if schedule is None:
+            from kivy.clock import Clock
+            schedule = Clock.schedule_once
+        future.add_done_callback(lambda future: schedule(deliver))
+        return future
+
+    def shutdown(self, wait=True):
+        """Stops the worker after the submitted calls have finished."""
+        self._executor.shutdown(wait=wait)
+
+
+class PlaylistChanges:
+    """Changes to the playlist since a version of the database.
+
+    Returned by :meth:`Database.get_playlist_changes`. The changes are read
+    on whichever thread makes the query and applied to a playlist with
+    :meth:`apply`, which doesn't touch the database.
+
+    Args:
+        version (int): the version the changes bring the playlist to.
+        playlist (Playlist, optional): The whole playlist, set when the
+            changes couldn't be worked out and the playlist was reloaded.
+        removed (set, optional): IDs of tracks no longer in the playlist.
+        placed (list, optional): (index, song) of tracks that were added or
+            moved, in the order of their indexes.
+        updated (list, optional): songs whose metadata changed.
+        current (int, optional): ID of the current track.
+    """
+
+    def __init__(self, version, playlist=None, removed=None, placed=None,
+                 updated=None, current=None):
+        self.version = version
+        self.playlist = playlist
+        self.removed = removed if removed is not None else set()
+        self.placed = placed if placed is not None else []
+        self.updated = updated if updated is not None else []
+        self.current = current
+
+    @property
+    def is_empty(self):
+        return (self.playlist is None
+                and not (self.removed or self.placed or self.updated)
+                and self.current is None)
+
+    def apply(self, playlist):
+        """Applies the changes to playlist and returns the updated playlist."""
+        if self.playlist is not None or playlist is None:
+            return self.playlist
+        if self.is_empty:
+            return playlist
+
+        current = playlist.current_track
+        moved = self.removed | {song.id for index, song in self.placed}
+        playlist.tracks = [track for track in playlist.tracks
+                           if track.id not in moved]
+        for index, song in self.placed:
+            playlist.tracks.insert(index, song)
+
+        updated = {song.id: song for song in self.updated}
+        for track in playlist.tracks:
+            song = updated.get(track.id)
+            if song is not None and song is not track:
+                track.update(song)
+
+        if self.current is not None:
+            current_id = self.current
+        else:
+            current_id = current.id if current is not None else None
+        playlist._current = (playlist.tracks.find(current_id)
+                             if current_id is not None else -1)
+        return playlist
+
+    def __repr__(self):
+        return (f'PlaylistChanges(version={self.version},'
+                f' reload={self.playlist is not None},'
+                f' removed={len(self.removed)}, placed={len(self.placed)},'
+                f' updated={len(self.updated)})')
 
 
 class Database:
     """Database class for all communications with the database."""
 
-    def __init__(self):
+    # Number of buffered play events that are written together, and the
+    # longest an event waits for the rest of its batch in seconds.
+    history_batch_size = 20
+    history_max_delay = 60
+
+    # Columns of the tracks table, in the order of Song's attributes.
+    track_columns = (
+        'id', 'name', 'artist', 'id_spotify', 'isrc', 'cover_art',
+        'preview_url', 'download_url', 'preview_file', 'download_file',
+        'genres',
+    )
+
+    def __init__(self, path: str = 'user.db'):
         self.playlist_table = 'playlist'
         self.favorites_table = 'favorites'
+        self.tracks_table = 'tracks'
         self.user_table = 'user'
+        self.connections = ConnectionManager(path)
+        self._history = []
+        self._history_lock = threading.Lock()
 
-    @get_cursor
+    def close(self) -> None:
+        """Writes the buffered play events and closes the connections."""
+        try:
+            self.flush_history()
+        except sqlite3.Error as e:
+            logging.error('DB: Lost %d play events: %s', len(self._history), e)
+        self.connections.close_all()
+
+    def transaction(self):
+        """Batches the writes made inside the block into one commit."""
+        return self.connections.transaction()
+
+    @contextmanager
+    def bulk_load(self):
+        """Batches the writes of the block and indexes them for search once.
+
+        Keeping the search index in sync row by row takes most of the time
+        of large imports, so its triggers are dropped for the block and the
+        index is rebuilt at the end of it, in the same transaction.
+        """
+        with self.transaction() as con, closing(con.cursor()) as cursor:
+            _drop_library_search_triggers(cursor)
+            yield con
+            if _table_columns(cursor, 'tracks_search'):
+                _create_library_search_triggers(cursor)
+                cursor.execute(
+                    "INSERT INTO tracks_search (tracks_search) VALUES ('rebuild');")
+
+    @write_cursor
     def insert(
         self,
         *data: Tuple[bool, str, str, Optional[str]],
@@ -45,24 +590,31 @@ class Database:
         """Inserts data into database.
 
         Args:
-            chat_id (int): Chat ID.
-            data (tuple): data fields for user.
+            data (tuple): data fields for the row. Favorites and playlist
+                rows start with the track's fields, followed by
+                date_favorited for favorites and current and position
+                for the playlist.
             table (str): table to insert into.
             cursor (Any): database cursor.
         """
         values = data
         if table == self.user_table:
             query = f"""INSERT INTO user VALUES (?,?,?,?,?,?,?);"""
-        elif table == self.favorites_table:
-            query = f"""INSERT INTO favorites VALUES (?,?,?,?,?,?,?,?,?,?,?);"""
-        elif table == self.playlist_table:
-            query = f"""INSERT INTO playlist VALUES (?,?,?,?,?,?,?,?,?,?,?,?);"""
+        elif table == self.tracks_table:
+            placeholders = ",".join("?" * len(self.track_columns))
+            query = f"""INSERT INTO tracks VALUES ({placeholders});"""
+        elif table in (self.favorites_table, self.playlist_table):
+            fields = len(self.track_columns)
+            self.insert(*values[:fields], table=self.tracks_table)
+            values = (values[0], *values[fields:])
+            placeholders = ",".join("?" * len(values))
+            query = f"""INSERT INTO {table} VALUES ({placeholders});"""
         else:
             raise ValueError(f"Unknown table {table}")
 
         cursor.execute(query, values)
 
-    @get_cursor
+    @write_cursor
     def _update_playlist(
         self,
         column: str,
@@ -70,11 +622,11 @@ class Database:
         data,
         cursor=None,
     ):
-        query = f"UPDATE playlist SET {column} = ? WHERE id == {id};"
+        query = f"UPDATE playlist SET {column} = ? WHERE track_id == {id};"
         values = (data,)
         cursor.execute(query, values)
 
-    @get_cursor
+    @write_cursor
     def _update_user(
         self,
         column: str,
@@ -85,7 +637,7 @@ class Database:
         values = (data,)
         cursor.execute(query, values)
 
-    @get_cursor
+    @write_cursor
     def _execute(self, query, cursor=None):
         cursor.execute(query)
 
@@ -110,78 +662,187 @@ class Database:
     def update_last_pos(self, value):
         self._update_user('last_pos', value)
 
-    @get_cursor
+    @write_cursor
     def update_current_track(self, track, cursor=None):
         cursor.execute("""UPDATE playlist SET current = 0 WHERE current = 1;""")
         self._update_playlist('current', track.id, True)
 
-    def _track_to_db(self, track, current=None):
-        track = [
+    def _track_to_db(self, track):
+        return [
             track.id, track.name, track.artist, track.id_spotify,
             track.isrc, track.cover_art, track.preview_url,
             track.download_url, track.preview_file,
-            track.download_file,
-            track.date_favorited
+            track.download_file, ",".join(track.genres),
         ]
-        if current is not None:
-            track.append(current)
-        return track
 
     def _db_to_track(self, track):
-        return Song(id=track[0],
-                    name=track[1],
-                    artist=track[2],
-                    id_spotify=track[3],
-                    isrc=track[4],
-                    cover_art=track[5],
-                    preview_url=track[6],
-                    download_url=track[7],
-                    preview_file=track[8],
-                    download_file=track[9],
-                    date_favorited=track[10],)
+        return Song.shared(id=track[0],
+                           name=track[1],
+                           artist=track[2],
+                           id_spotify=track[3],
+                           isrc=track[4],
+                           cover_art=track[5],
+                           preview_url=track[6],
+                           download_url=track[7],
+                           preview_file=track[8],
+                           download_file=track[9],
+                           genres=track[10].split(',') if track[10] else [],
+                           date_favorited=track[11],)
 
-    @get_cursor
+    # Selects tracks in _db_to_track's order. Joined on favorites so that
+    # every track knows whether it's been favorited.
+    _select_tracks = """SELECT t.id, t.name, t.artist, t.id_spotify, t.isrc,
+                               t.cover_art, t.preview_url, t.download_url,
+                               t.preview_file, t.download_file, t.genres,
+                               f.date_favorited"""
+
+    def _save_tracks(self, tracks, cursor=None):
+        """Inserts tracks or updates the ones that are already saved.
+
+        Saved file paths are kept when the given track doesn't have one,
+        since the other process might have downloaded the file meanwhile.
+        Saved genres are kept too, since only API results know them.
+        """
+        update = """UPDATE tracks SET name = ?, artist = ?, id_spotify = ?,
+                           isrc = ?, cover_art = ?, preview_url = ?,
+                           download_url = ?,
+                           preview_file = COALESCE(?, preview_file),
+                           download_file = COALESCE(?, download_file),
+                           genres = COALESCE(NULLIF(?, ''), genres)
+                    WHERE id = ?;"""
+        insert = """INSERT INTO tracks VALUES (?,?,?,?,?,?,?,?,?,?,?);"""
+        for track in tracks:
+            values = self._track_to_db(track)
+            cursor.execute(update, values[1:] + values[:1])
+            if cursor.rowcount == 0:
+                cursor.execute(insert, values)
+
+    def _prune_tracks(self, id=None, cursor=None):
+        """Removes tracks that aren't in the playlist, favorites or history.
+
+        Args:
+            id (int, optional): Only consider this track.
+            cursor (Any): database cursor.
+        """
+        query = """DELETE FROM tracks
+                   WHERE NOT EXISTS (SELECT 1 FROM playlist
+                                     WHERE playlist.track_id = tracks.id)
+                   AND NOT EXISTS (SELECT 1 FROM favorites
+                                   WHERE favorites.track_id = tracks.id)
+                   AND NOT EXISTS (SELECT 1 FROM history
+                                   WHERE history.track_id = tracks.id)"""
+        if id is not None:
+            cursor.execute(query + " AND id = ?;", (id,))
+        else:
+            cursor.execute(query + ";")
+
+    @write_cursor
     def update_playlist(self, playlist, cursor=None):
         cursor.execute("""DELETE FROM playlist;""")
-        query = """INSERT INTO playlist VALUES (?,?,?,?,?,?,?,?,?,?,?,?);"""
-        values = [self._track_to_db(track, current=True if i == 0 else False)
+        self._save_tracks(playlist.tracks, cursor=cursor)
+        query = """INSERT INTO playlist VALUES (?,?,?);"""
+        current = playlist.current_track_index
+        values = [(track.id, i == current, i * POSITION_STEP)
                   for i, track in enumerate(playlist.tracks)]
         cursor.executemany(query, values)
+        self._prune_tracks(cursor=cursor)
 
-    @get_cursor
+    @write_cursor
     def remove_playlist_track(self, track, cursor=None):
-        cursor.execute(f"""DELETE FROM playlist where id =  {track.id};""")
+        cursor.execute("""DELETE FROM playlist where track_id = ?;""", (track.id,))
+        self._prune_tracks(track.id, cursor=cursor)
 
-    @get_cursor
+    @write_cursor
     def remove_favorites_track(self, track, cursor=None):
-        cursor.execute(f"""DELETE FROM favorites where id = {track.id};""")
+        cursor.execute("""DELETE FROM favorites where track_id = ?;""", (track.id,))
+        self._prune_tracks(track.id, cursor=cursor)
 
-    @get_cursor
-    def add_playlist_track(self, track, index, cursor=None):
+    def _position_at(self, index, exclude=None, cursor=None):
+        """Returns a position that puts a track at index in the playlist.
+
+        Args:
+            index (int): Index of the track in the playlist. -1 appends it.
+            exclude (int, optional): ID of a track to leave out when counting
+                indexes, used when a track is moved.
+            cursor (Any): database cursor.
+        """
+        exclude = exclude if exclude is not None else -1
         if index == -1:
-            query = """INSERT INTO playlist VALUES (?,?,?,?,?,?,?,?,?,?,?,?);"""
-            values = self._track_to_db(track, current=False)
-            cursor.execute(query, values)
-        else:
-            playlist = self.get_playlist()
-            playlist.tracks.insert(index, track)
-            self.update_playlist(playlist)
+            cursor.execute("SELECT MAX(position) FROM playlist WHERE track_id != ?;",
+                           (exclude,))
+            last = cursor.fetchone()[0]
+            return last + POSITION_STEP if last is not None else 0.0
 
-    @get_cursor
+        query = """SELECT position FROM playlist WHERE track_id != ?
+                   ORDER BY position LIMIT 2 OFFSET ?;"""
+        cursor.execute(query, (exclude, max(index - 1, 0)))
+        neighbours = [row[0] for row in cursor.fetchall()]
+        if index == 0:
+            return neighbours[0] - POSITION_STEP if neighbours else 0.0
+        if not neighbours:
+            return self._position_at(-1, exclude, cursor=cursor)
+        if len(neighbours) == 1:
+            return neighbours[0] + POSITION_STEP
+
+        before, after = neighbours
+        position = (before + after) / 2
+        if not before < position < after:
+            self._renumber_playlist(cursor=cursor)
+            return self._position_at(index, exclude, cursor=cursor)
+        return position
+
+    def _renumber_playlist(self, cursor=None):
+        """Spreads the playlist positions out evenly again."""
+        cursor.execute("SELECT track_id FROM playlist ORDER BY position;")
+        values = [(i * POSITION_STEP, row[0])
+                  for i, row in enumerate(cursor.fetchall())]
+        cursor.executemany("UPDATE playlist SET position = ? WHERE track_id = ?;",
+                           values)
+        logging.debug('DB: Renumbered %d playlist positions', len(values))
+
+    @write_cursor
+    def add_playlist_track(self, track, index, cursor=None):
+        self._save_tracks([track], cursor=cursor)
+        position = self._position_at(index, cursor=cursor)
+        query = """INSERT INTO playlist VALUES (?,?,?);"""
+        cursor.execute(query, (track.id, False, position))
+
+    @write_cursor
+    def move_playlist_track(self, track, index, cursor=None):
+        position = self._position_at(index, exclude=track.id, cursor=cursor)
+        cursor.execute("UPDATE playlist SET position = ? WHERE track_id = ?;",
+                       (position, track.id))
+
+    @write_cursor
     def add_favorites_track(self, track, cursor=None):
-        query = """INSERT INTO favorites VALUES (?,?,?,?,?,?,?,?,?,?,?);"""
-        values = self._track_to_db(track, current=None)
-        cursor.execute(query, values)
+        self._save_tracks([track], cursor=cursor)
+        query = """INSERT OR REPLACE INTO favorites VALUES (?,?);"""
+        cursor.execute(query, (track.id, track.date_favorited))
 
-    @get_cursor
+    @write_cursor
     def delete_user(self, cursor=None):
-        for table in ('user', 'favorites', 'playlist'):
+        for table in ('user', 'favorites', 'playlist', 'tracks'):
             query = f"""DROP TABLE {table};"""
             cursor.execute(query)
+        for table in ('tracks_search', 'history', 'play_counts'):
+            cursor.execute(f"""DROP TABLE IF EXISTS {table};""")
+        if _table_columns(cursor, 'changes'):
+            # Dropping the tables isn't logged. Emptying the log and
+            # skipping a version makes processes that still have the old
+            # playlist reload it instead of applying the new one's changes
+            # on top of it.
+            cursor.execute("DELETE FROM changes;")
+            cursor.execute("""UPDATE sqlite_sequence SET seq = seq + 1
+                              WHERE name = 'changes';""")
+        cursor.execute("PRAGMA user_version = 0;")
 
     @get_cursor
     def get_playlist(self, cursor=None):
-        query = """SELECT * FROM playlist ORDER BY rowid"""
+        query = self._select_tracks + """, p.current
+                   FROM playlist p
+                   JOIN tracks t ON t.id = p.track_id
+                   LEFT JOIN favorites f ON f.track_id = p.track_id
+                   ORDER BY p.position"""
         cursor.execute(query)
         tracks = cursor.fetchall()
         for i, track in enumerate(tracks):
@@ -193,12 +854,353 @@ class Database:
         return Playlist(tracks=[self._db_to_track(track) for track in tracks],
                         current=current)
 
+    @get_cursor
+    def get_version(self, cursor=None):
+        """Returns the version of the latest change to the database."""
+        # Read from the sequence rather than the log, which may be empty.
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes';")
+        row = cursor.fetchone()
+        return row[0] if row is not None else 0
+
+    @get_cursor
+    def get_playlist_changes(self, version=None, limit=50, cursor=None):
+        """Returns what changed in the playlist since version.
+
+        Args:
+            version (int, optional): The version the caller's playlist is
+                at. Leave empty to load the whole playlist.
+            limit (int): Number of changed rows above which the playlist is
+                reloaded instead.
+            cursor (Any): database cursor.
+
+        Returns:
+            PlaylistChanges: the changes, which bring the playlist to the
+            latest version once applied.
+        """
+        # The version is read before the data, so at worst changes that
+        # are already in the data are applied again, which is harmless.
+        latest = self.get_version()
+        if version is not None and version >= latest:
+            return PlaylistChanges(latest)
+
+        if version is not None:
+            cursor.execute("""SELECT MIN(version) FROM changes;""")
+            oldest = cursor.fetchone()[0]
+            query = """SELECT table_name, track_id FROM changes
+                       WHERE version > ? ORDER BY version LIMIT ?;"""
+            cursor.execute(query, (version, limit + 1))
+            rows = cursor.fetchall()
+        if (version is None or oldest is None or oldest > version + 1
+                or len(rows) > limit):
+            return PlaylistChanges(latest, playlist=self.get_playlist())
+
+        moved = {id for table, id in rows if table == 'playlist'}
+        updated = {id for table, id in rows if table != 'playlist'} - moved
+        changes = PlaylistChanges(latest)
+
+        if moved:
+            placeholders = ",".join("?" * len(moved))
+            query = self._select_tracks + f""", p.position
+                       FROM playlist p
+                       JOIN tracks t ON t.id = p.track_id
+                       LEFT JOIN favorites f ON f.track_id = p.track_id
+                       WHERE p.track_id IN ({placeholders})
+                       ORDER BY p.position;"""
+            cursor.execute(query, list(moved))
+            for track in cursor.fetchall():
+                cursor.execute("SELECT COUNT(*) FROM playlist WHERE position < ?;",
+                               (track[-1],))
+                index = cursor.fetchone()[0]
+                changes.placed.append((index, self._db_to_track(track)))
+            changes.removed = moved - {song.id for index, song in changes.placed}
+
+            cursor.execute("SELECT track_id FROM playlist WHERE current = 1;")
+            current = cursor.fetchone()
+            changes.current = current[0] if current is not None else None
+
+        if updated:
+            placeholders = ",".join("?" * len(updated))
+            query = self._select_tracks + f"""
+                       FROM playlist p
+                       JOIN tracks t ON t.id = p.track_id
+                       LEFT JOIN favorites f ON f.track_id = p.track_id
+                       WHERE p.track_id IN ({placeholders});"""
+            cursor.execute(query, list(updated))
+            changes.updated = [self._db_to_track(track)
+                               for track in cursor.fetchall()]
+        return changes
+
     @get_cursor
     def get_favorites(self, cursor=None):
-        query = """SELECT * FROM favorites"""
+        query = self._select_tracks + """
+                   FROM favorites f
+                   JOIN tracks t ON t.id = f.track_id
+                   ORDER BY f.date_favorited"""
         cursor.execute(query)
         tracks = cursor.fetchall()
-        return [self._db_to_track(track) for track in tracks]
+        return Favorites(self._db_to_track(track) for track in tracks)
+
+    # Columns favorites can be sorted by and the track id that breaks ties.
+    # Each column is backed by an index whose entries also hold that id, so
+    # pages are read in index order without sorting.
+    favorites_order = {
+        'date_favorited': ('f.date_favorited', 'f.track_id'),
+        'name': ('t.name', 't.id'),
+        'artist': ('t.artist', 't.id'),
+    }
+
+    @get_cursor
+    def get_favorites_page(
+        self,
+        order='date_favorited',
+        descending=False,
+        after=None,
+        limit=30,
+        cursor=None,
+    ):
+        """Returns one page of favorites.
+
+        Pages are fetched with a keyset instead of an offset, so every page
+        costs the same no matter how far into the favorites it is.
+
+        Songs without a value for the column come first in ascending order
+        and last in descending order, by id.
+
+        Args:
+            order (str): date_favorited, name or artist.
+            descending (bool): sort in descending order.
+            after (tuple, optional): the cursor returned with the previous
+                page. Leave empty to get the first page.
+            limit (int): number of songs in a page.
+            cursor (Any): database cursor.
+
+        Returns:
+            tuple: list of songs and the cursor of the next page, which is
+            None if this was the last page.
+        """
+        if order not in self.favorites_order:
+            raise ValueError(f"Unknown order {order}")
+        column, id_column = self.favorites_order[order]
+        direction = 'DESC' if descending else 'ASC'
+        comparison = '<' if descending else '>'
+        # NULLs can't be compared, so they're read separately from the
+        # other values. Each part is a range of the column's index.
+        parts = [(True, f"{column} IS NULL"),
+                 (False, f"{column} IS NOT NULL")]
+        if descending:
+            parts.reverse()
+        if after is not None:
+            while parts[0][0] != (after[0] is None):
+                parts.pop(0)
+        tracks = []
+        for is_null, where in parts:
+            values = []
+            if after is not None:
+                if is_null:
+                    where += f" AND {id_column} {comparison} ?"
+                    values = [after[1]]
+                else:
+                    where += f" AND ({column}, {id_column}) {comparison} (?, ?)"
+                    values = [after[0], after[1]]
+                after = None
+            query = self._select_tracks + f""", {column}
+                   FROM favorites f
+                   JOIN tracks t ON t.id = f.track_id
+                   WHERE {where}
+                   ORDER BY {column} {direction}, {id_column} {direction}
+                   LIMIT ?;"""
+            cursor.execute(query, values + [limit - len(tracks)])
+            tracks.extend(cursor.fetchall())
+            if len(tracks) == limit:
+                break
+        if len(tracks) == limit:
+            next_page = (tracks[-1][-1], tracks[-1][0])
+        else:
+            next_page = None
+        return [self._db_to_track(track) for track in tracks], next_page
+
+    # Length of search text below which results aren't ranked.
+    ranked_search_min_length = 4
+
+    def _search_terms(self, text):
+        """Turns what the user typed into a prefix query for every word."""
+        words = "".join(c if c.isalnum() else " " for c in text).split()
+        return " ".join(f'"{word}"*' for word in words)
+
+    @get_cursor
+    def search_library(self, text, favorites_only=False, limit=20, cursor=None):
+        """Searches the names and artists of saved tracks.
+
+        Every word in the text is matched as a prefix, so results show up
+        while the user is still typing. Ranking reads every match, which
+        takes too long for short prefixes that match most of a large
+        library, so text shorter than :attr:`ranked_search_min_length` gets
+        the first matches unranked.
+
+        Args:
+            text (str): search text.
+            favorites_only (bool): only search favorites instead of
+                favorites, the playlist and the listening history.
+            limit (int): maximum number of results.
+            cursor (Any): database cursor.
+
+        Returns:
+            list: matching songs, best matches first.
+        """
+        terms = self._search_terms(text)
+        if not terms:
+            return []
+        scope = """EXISTS (SELECT 1 FROM favorites WHERE track_id = t.id)"""
+        if not favorites_only:
+            scope += """
+                   OR EXISTS (SELECT 1 FROM playlist WHERE track_id = t.id)
+                   OR EXISTS (SELECT 1 FROM history WHERE track_id = t.id)"""
+        ranked = len(text.strip()) >= self.ranked_search_min_length
+        try:
+            query = self._select_tracks + f"""
+                   FROM tracks_search s
+                   JOIN tracks t ON t.id = s.rowid
+                   LEFT JOIN favorites f ON f.track_id = t.id
+                   WHERE tracks_search MATCH ? AND ({scope})
+                   {'ORDER BY s.rank' if ranked else ''}
+                   LIMIT ?;"""
+            cursor.execute(query, (terms, limit))
+        except sqlite3.OperationalError as e:
+            logging.debug('DB: Full-text search failed, using LIKE: %s', e)
+            words = text.split()
+            conditions = " AND ".join(
+                "(t.name LIKE ? OR t.artist LIKE ?)" for _ in words)
+            query = self._select_tracks + f"""
+                   FROM tracks t
+                   LEFT JOIN favorites f ON f.track_id = t.id
+                   WHERE {conditions} AND ({scope})
+                   ORDER BY t.name
+                   LIMIT ?;"""
+            values = [f"%{word}%" for word in words for _ in range(2)]
+            cursor.execute(query, values + [limit])
+        return [self._db_to_track(track) for track in cursor.fetchall()]
+
+    def record_event(self, track, event, position=None):
+        """Adds a play event to the listening history.
+
+        Events are buffered in memory and written in one transaction once
+        history_batch_size of them have piled up, or with the first event
+        after the oldest one has waited history_max_delay seconds. Call
+        :meth:`flush_history` to write them sooner.
+
+        Args:
+            track (Song): the track the event happened to.
+            event (str): 'play', 'skip' or 'complete'.
+            position (float, optional): playback position of the event
+                in seconds.
+        """
+        if event not in ('play', 'skip', 'complete'):
+            raise ValueError(f"Unknown event {event}")
+        now = time()
+        with self._history_lock:
+            self._history.append(
+                (track.id, track.artist, tuple(track.genres), event, now, position))
+            flush = (len(self._history) >= self.history_batch_size
+                     or now - self._history[0][4] >= self.history_max_delay)
+        if flush:
+            self.flush_history()
+
+    def flush_history(self) -> int:
+        """Writes the buffered play events and returns how many there were."""
+        with self._history_lock:
+            events, self._history = self._history, []
+        if not events:
+            return 0
+        try:
+            self._write_history(events)
+        except sqlite3.Error:
+            with self._history_lock:
+                self._history[:0] = events
+            raise
+        return len(events)
+
+    @write_cursor
+    def _write_history(self, events, cursor=None):
+        query = """INSERT INTO history (track_id, event, date, position)
+                   VALUES (?,?,?,?);"""
+        cursor.executemany(
+            query,
+            ((id, event, when, position)
+             for id, artist, genres, event, when, position in events),
+        )
+
+        # Add the events up per row of play_counts first, so each row is
+        # written once per flush.
+        counts = {}
+        column = {'play': 0, 'skip': 1, 'complete': 2}
+        for id, artist, genres, event, when, position in events:
+            keys = [('track', id), ('artist', artist)]
+            keys.extend(('genre', genre) for genre in genres)
+            for day in (date.fromtimestamp(when).toordinal(), 0):
+                for kind, key in keys:
+                    row = counts.setdefault((kind, key, day), [0, 0, 0, when])
+                    row[column[event]] += 1
+                    row[3] = max(row[3], when)
+
+        cursor.executemany(
+            """INSERT OR IGNORE INTO play_counts (kind, key, day) VALUES (?,?,?);""",
+            counts.keys(),
+        )
+        query = """UPDATE play_counts
+                   SET plays = plays + ?, skips = skips + ?,
+                       completes = completes + ?,
+                       last_played = MAX(COALESCE(last_played, 0), ?)
+                   WHERE kind = ? AND key = ? AND day = ?;"""
+        cursor.executemany(query, (row + list(key) for key, row in counts.items()))
+
+    @get_cursor
+    def get_most_played(self, kind='track', day=None, limit=20, cursor=None):
+        """Returns what was played the most, with the number of plays.
+
+        Args:
+            kind (str): 'track', 'artist' or 'genre'.
+            day (datetime.date, optional): Only count the plays of this
+                day. Leave empty for all-time counts.
+            limit (int): number of results.
+            cursor (Any): database cursor.
+
+        Returns:
+            list: (Song, plays) for tracks, or (name, plays) for artists
+            and genres, most played first.
+        """
+        self.flush_history()
+        day = day.toordinal() if day is not None else 0
+        if kind == 'track':
+            query = self._select_tracks + """, c.plays
+                       FROM play_counts c
+                       JOIN tracks t ON t.id = c.key
+                       LEFT JOIN favorites f ON f.track_id = t.id
+                       WHERE c.kind = 'track' AND c.day = ? AND c.plays > 0
+                       ORDER BY c.plays DESC
+                       LIMIT ?;"""
+            cursor.execute(query, (day, limit))
+            return [(self._db_to_track(row), row[-1]) for row in cursor.fetchall()]
+
+        query = """SELECT key, plays FROM play_counts
+                   WHERE kind = ? AND day = ? AND plays > 0
+                   ORDER BY plays DESC
+                   LIMIT ?;"""
+        cursor.execute(query, (kind, day, limit))
+        return cursor.fetchall()
+
+    @get_cursor
+    def get_recently_played(self, limit=20, cursor=None):
+        """Returns the tracks that were played last, most recent first."""
+        self.flush_history()
+        query = self._select_tracks + """
+                   FROM play_counts c
+                   JOIN tracks t ON t.id = c.key
+                   LEFT JOIN favorites f ON f.track_id = t.id
+                   WHERE c.kind = 'track' AND c.day = 0
+                   ORDER BY c.last_played DESC
+                   LIMIT ?;"""
+        cursor.execute(query, (limit,))
+        return [self._db_to_track(row) for row in cursor.fetchall()]
 
     @get_cursor
     def get_user(self, cursor=None):
@@ -222,18 +1224,96 @@ class Database:
     @get_cursor
     def get_track(self, id, cursor=None):
         values = (id,)
-        query = f"SELECT * FROM playlist where id = ?;"
+        query = self._select_tracks + """
+                   FROM tracks t
+                   LEFT JOIN favorites f ON f.track_id = t.id
+                   WHERE t.id = ?;"""
         cursor.execute(query, values)
-        return self._db_to_track(cursor.fetchone())
+        row = cursor.fetchone()
+        return self._db_to_track(row) if row is not None else None
 
-    @get_cursor
+    @write_cursor
     def update_track(self, track, column, value, cursor=None):
-        values = (value,)
-        for table in ('playlist', 'favorites'):
-            query = f"UPDATE {table} SET {column} = ? WHERE id = {track.id};"
-            cursor.execute(query, values)
+        if column not in self.track_columns:
+            raise ValueError(f"Unknown track column {column}")
+        query = f"UPDATE tracks SET {column} = ? WHERE id = ?;"
+        cursor.execute(query, (value, track.id))
+
+    def _create_track_tables(self, cursor=None):
+        # Tracks
+        cursor.execute('''CREATE TABLE tracks
+                     (id integer PRIMARY KEY,
+                      name TEXT,
+                      artist TEXT,
+                      id_spotify TEXT,
+                      isrc TEXT,
+                      cover_art TEXT,
+                      preview_url TEXT,
+                      download_url TEXT,
+                      preview_file TEXT,
+                      download_file TEXT,
+                      genres TEXT)
+                 ''')
+        cursor.execute('''CREATE INDEX tracks_id_spotify ON tracks (id_spotify)''')
+        cursor.execute('''CREATE INDEX tracks_isrc ON tracks (isrc)''')
+        cursor.execute('''CREATE INDEX tracks_name ON tracks (name)''')
+        cursor.execute('''CREATE INDEX tracks_artist ON tracks (artist)''')
+        _create_library_search(cursor)
+
+        # Favorites
+        cursor.execute('''CREATE TABLE favorites
+                     (track_id integer PRIMARY KEY REFERENCES tracks (id),
+                      date_favorited real)
+                 ''')
+        cursor.execute('''CREATE INDEX favorites_date ON favorites (date_favorited)''')
+
+        # Playlist
+        cursor.execute('''CREATE TABLE playlist
+                     (track_id integer PRIMARY KEY REFERENCES tracks (id),
+                      current boolean DEFAULT 0,
+                      position real NOT NULL)
+                     ''')
+        cursor.execute('''CREATE INDEX playlist_position ON playlist (position)''')
+        cursor.execute('''CREATE INDEX playlist_current ON playlist (current)''')
 
     @get_cursor
+    def schema_version(self, cursor=None):
+        cursor.execute("PRAGMA user_version;")
+        return cursor.fetchone()[0]
+
+    def migrate(self):
+        """Applies the migrations this database hasn't gone through yet.
+
+        Each migration runs in its own transaction together with the bump
+        of the database's user_version, so an interrupted migration is
+        retried from scratch on the next start. New databases are created
+        at the latest version by :meth:`initialize` and skip all of them.
+
+        Returns:
+            list: (version, seconds) of every migration that was applied.
+        """
+        applied = []
+        if self.schema_version() >= SCHEMA_VERSION:
+            return applied
+        for version, migration in enumerate(MIGRATIONS, start=1):
+            with self.transaction() as con:
+                with closing(con.cursor()) as cursor:
+                    # The other process might have migrated in the meantime.
+                    if self.schema_version() >= version:
+                        continue
+                    if not _table_columns(cursor, 'user'):
+                        # Nothing to migrate before initialize() runs.
+                        break
+                    start = perf_counter()
+                    migration(cursor)
+                    cursor.execute(f"PRAGMA user_version = {version};")
+            elapsed = perf_counter() - start
+            applied.append((version, elapsed))
+            logging.info('DB: Migrated to version %d (%s) in %.3fs',
+                         version, migration.__name__, elapsed)
+        return applied
+
+    @write_cursor
     def initialize(self, genres, artists, songs_path, playlist, cursor=None):
         # User
         cursor.execute('''CREATE TABLE user
@@ -252,35 +1332,8 @@ class Database:
         query = 'INSERT INTO user (id, genres, artists, songs_path) VALUES (?,?,?,?)'
         cursor.execute(query, user)
 
-        # Favorites
-        cursor.execute('''CREATE TABLE favorites
-                     (id integer UNIQUE,
-                      name TEXT,
-                      artist TEXT,
-                      id_spotify TEXT unique,
-                      isrc TEXT unique,
-                      cover_art TEXT,
-                      preview_url TEXT,
-                     download_url TEXT,
-                     preview_file TEXT,
-                     download_file TEXT,
-                     date_favorited real)
-                 ''')
-
-        # Playlist
-        cursor.execute('''CREATE TABLE playlist
-                     (id integer UNIQUE,
-                      name TEXT,
-                      artist TEXT,
-                      id_spotify TEXT unique,
-                      isrc TEXT unique,
-                      cover_art TEXT,
-                      preview_url TEXT,
-                     download_url TEXT,
-                     preview_file TEXT,
-                     download_file TEXT,
-                     date_favorited real,
-                     current boolean DEFAULT 0
-                     )
-                     ''')
+        self._create_track_tables(cursor=cursor)
+        _create_change_log(cursor)
+        _create_history(cursor)
         self.update_playlist(playlist)
+        cursor.execute(f"PRAGMA user_version = {SCHEMA_VERSION};")
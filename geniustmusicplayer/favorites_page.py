@@ -1,4 +1,5 @@
 from kivymd.app import MDApp
+from kivy.clock import Clock
 from kivy.uix.floatlayout import FloatLayout
 from kivymd.uix.list import TwoLineAvatarIconListItem
 from kivymd.uix.menu import MDDropdownMenu
@@ -59,9 +60,18 @@ class SortMenu(MDDropdownMenu):
 
 
 class FavoritesPage(FloatLayout):
+    page_size = 30
+    sort_orders = {
+        'Date Added': 'date_favorited',
+        'Song Title': 'name',
+        'Artist Name': 'artist',
+    }
+
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.app = MDApp.get_running_app()
+        self.next_page = None
+        self.search_trigger = Clock.create_trigger(self.search, 0.3)
         menu_items = [
             {"text": "Date Added"},
             {"text": "Song Title"},
@@ -82,50 +92,120 @@ class FavoritesPage(FloatLayout):
         self.menu.dismiss()
         self.set_songs()
 
+    def register_input(self):
+        # search once the user stops typing
+        self.search_trigger.cancel()
+        self.search_trigger()
+
+    def search(self, *args):
+        text = self.ids.search_field.text.strip()
+        if not text:
+            self.set_songs()
+            return
+
+        def show(songs):
+            # drop the results if the user typed on in the meantime
+            if self.ids.search_field.text.strip() == text:
+                self.show_results(songs)
+
+        self.app.db_worker.submit(self.app.db.search_library,
+                                  text,
+                                  favorites_only=True,
+                                  callback=show)
+
+    def show_results(self, songs):
+        self.next_page = None
+        self.ids.favorites_list.clear_widgets()
+        self.ids.favorites_scroll.scroll_y = 1
+        for song in songs:
+            self.ids.favorites_list.add_widget(
+                FavoriteSongListItem(song=song, size_hint=(1, None))
+            )
+
     def set_songs(self):
+        if self.ids.search_field.text.strip():
+            self.search()
+            return
         sort = self.ids.drop_item.current_item
         disabled_hint_text_color = self.app.theme_cls.disabled_hint_text_color
         if self.ids.sort_descending.text_color != disabled_hint_text_color:
             descending = True
         else:
             descending = False
-        songs = self.app.db.get_favorites()
-
-        def sort_by(song):
-            if sort == 'Date Added':
-                return song.date_favorited
-            elif sort == 'Song Title':
-                return song.name
-            else:
-                return song.artist
-        songs.sort(reverse=descending, key=lambda x: sort_by(x))
+        self.order = self.sort_orders.get(sort, 'artist')
+        self.descending = descending
+        self.next_page = None
         self.ids.favorites_list.clear_widgets()
+        self.ids.favorites_scroll.scroll_y = 1
+        self.add_page()
+
+    def add_page(self, *args):
+        songs, self.next_page = self.app.db.get_favorites_page(
+            order=self.order,
+            descending=self.descending,
+            after=self.next_page,
+            limit=self.page_size,
+        )
+        favorites_list = self.ids.favorites_list
+        last_item = favorites_list.children[0] if favorites_list.children else None
         for song in songs:
-            self.ids.favorites_list.add_widget(
+            favorites_list.add_widget(
                 FavoriteSongListItem(song=song, size_hint=(1, None))
             )
-
-    def playlist_add(self, song, index=-1):
-        self.app.playlist = self.app.db.get_playlist()
-        if song not in self.app.playlist.tracks:
-            if index == -1:
-                self.app.playlist.tracks.append(song)
+        if last_item is not None:
+            # keep the list where it was instead of jumping to the new end
+            Clock.schedule_once(lambda *args: self.ids.favorites_scroll.scroll_to(
+                last_item, padding=0, animate=False))
+
+    def on_favorites_scroll(self, scroll_view, scroll_y):
+        # load the next page when the user nears the end of the list
+        if self.next_page is not None and scroll_y <= 0.05:
+            self.add_page()
+
+    def playlist_add(self, song, index=-1, callback=None):
+        """Adds the song to the playlist.
+
+        Args:
+            song (Song): song to add.
+            index (int, optional): index of the song in the playlist. -1
+                appends it and None puts it after the current track.
+            callback (Callable, optional): Called once the song is in the
+                playlist.
+        """
+        def add(playlist):
+            if song in playlist.tracks:
+                if callback is not None:
+                    callback()
+                else:
+                    toast('Song already in playlist')
+                return
+            position = playlist.current_track_index + 1 if index is None else index
+            if position == -1:
+                playlist.tracks.append(song)
             else:
-                self.app.playlist.tracks.insert(index, song)
-            self.app.db.add_playlist_track(song, index)
-            toast('Song added to playlist')
-        else:
-            toast('Song already in playlist')
+                playlist.insert(position, song)
+
+            def added(*args):
+                toast('Song added to playlist')
+                if callback is not None:
+                    callback()
+            self.app.db_worker.submit(self.app.db.add_playlist_track,
+                                      song,
+                                      position,
+                                      callback=added)
+
+        self.app.sync_playlist(callback=add)
 
     def play_song(self, song):
-        self.app.playlist = self.app.db.get_playlist()
-        if song not in self.app.playlist.tracks:
-            self.playlist_add(song, index=self.app.playlist.current_track_index + 1)
-        self.app.main_page.play_from_playlist(song)
+        self.playlist_add(
+            song,
+            index=None,
+            callback=lambda: self.app.main_page.play_from_playlist(song),
+        )
 
     def remove_song(self, song):
         if song == self.app.song.song_object:
             self.app.main_page.favorite_button.favorited = False
-        self.app.favorites.remove(song)
+        self.app.favorites.discard(song)
         self.app.db.remove_favorites_track(song)
         self.set_songs()
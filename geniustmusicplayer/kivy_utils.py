@@ -1,7 +1,3 @@
-import functools
-import inspect
-from functools import wraps
-
 from kivy.uix.screenmanager import Screen
 from kivy.logger import Logger
 from kivy.core.window import Window
@@ -9,6 +5,8 @@ from kivymd.app import MDApp
 from kivymd.uix.snackbar import Snackbar
 from kivymd.uix.button import MDFlatButton
 
+from utils import log
+
 
 def create_snackbar(text, callback):
     snackbar = Snackbar(
@@ -29,43 +27,6 @@ def create_snackbar(text, callback):
     return snackbar
 
 
-def get_class_that_defined_method(meth):
-    if isinstance(meth, functools.partial):
-        return get_class_that_defined_method(meth.func)
-    if (inspect.ismethod(meth)
-        or (inspect.isbuiltin(meth)
-            and getattr(meth, '__self__', None) is not None
-            and getattr(meth.__self__, '__class__', None))):
-        for cls in inspect.getmro(meth.__self__.__class__):
-            if meth.__name__ in cls.__dict__:
-                return cls
-        meth = getattr(meth, '__func__', meth)  # fallback to __qualname__ parsing
-    if inspect.isfunction(meth):
-        cls = getattr(inspect.getmodule(meth),
-                      meth.__qualname__.split('.<locals>', 1)[0].rsplit('.', 1)[0],
-                      None)
-        if isinstance(cls, type):
-            return cls
-    return getattr(meth, '__objclass__', None)  # handle special descriptor objects
-
-
-def log(func):
-    """logs entering and exiting functions for debugging."""
-
-    @wraps(func)
-    def wrapper(*args, **kwargs):
-        cls = get_class_that_defined_method(func)
-        if cls is not None:
-            cls = cls.__name__
-        # Logger.debug("Entering: %s.%s", cls, func.__name__)
-        result = func(*args, **kwargs)
-        # Logger.debug("Exiting: %s.%s (return value: %s)",
-        #             cls, func.__name__, repr(result))
-        return result
-
-    return wrapper
-
-
 @log
 def save_favorites(favorites):
     save_keys(favorites=[song.to_dict() for song in favorites])
@@ -27,7 +27,8 @@ from kivy.utils import platform
 from kivy.metrics import dp
 
 from api import API
-from db import Database
+from db import Database, DatabaseWorker
+from utils import log
 
 
 my_logger = logging.getLogger('gtplayer')
@@ -74,11 +75,19 @@ class ServerSong():
         self.ready = True
         Logger.debug("ACTIVITY: Service is ready.")
 
-    def playing(self, id, pos):
+    def playing(self, id, pos, synced=False):
         Logger.debug('ACTIVITY: Playing.')
         self.state = 'play'
         self.last_pos = pos
         song = self.app.playlist.get_track(id=id)
+        if song is None:
+            if synced:
+                Logger.error('ACTIVITY: %d is not in the playlist.', id)
+                return
+            # The service queued it after the playlist was last synced.
+            self.app.sync_playlist(
+                callback=lambda playlist: self.playing(id, pos, synced=True))
+            return
         play_button = self.app.play_button
         if self.song_object != song:
             play_button.load_song(song, playing=True)
@@ -151,7 +160,7 @@ class ServerSong():
         self.pos_callback(value)
 
     def update_playlist(self):
-        self.app.playlist = self.app.db.get_playlist()
+        self.app.sync_playlist()
         Logger.debug('ACTIVITY: Updated playlist.')
 
 
@@ -250,6 +259,7 @@ class PlayButton(ButtonBehavior, Image):
         app.main_page.edit_ui_for_song(song, playing=playing)
         app.playlist.set_current(song)
 
+    @log
     def play_track(self, song, seek=0):
         self.update_track_current(current=seek)
         self.source = f'images/stop_{app.theme_cls.theme_style.lower()}.png'
@@ -374,13 +384,13 @@ class FavoriteButton(MDIconButton):
         if not self.favorited:
             app.song.song_object.date_favorited = time()
             self.favorited = True
-            app.favorites.append(app.song.song_object)
-            app.db.add_favorites_track(app.song.song_object)
+            app.favorites.add(app.song.song_object)
+            app.db_worker.submit(app.db.add_favorites_track, app.song.song_object)
         else:
             app.song.song_object.date_favorited = None
             self.favorited = False
-            app.favorites.remove(app.song.song_object)
-            app.db.remove_favorites_track(app.song.song_object)
+            app.favorites.discard(app.song.song_object)
+            app.db_worker.submit(app.db.remove_favorites_track, app.song.song_object)
 
 
 class MyBaseListItem(ContainerSupport, BaseListItem):
@@ -419,6 +429,7 @@ class MainPage(FloatLayout):
         self.song = self.app.song
         self.playlist_menu = None
 
+    @log
     def edit_ui_for_song(self, song=None, playing=False):
         if app.song:
             self.ids.track_length.text = str(timedelta(
@@ -439,9 +450,16 @@ class MainPage(FloatLayout):
             self.update_song_info(song)
             self.song = song
 
-    def update_playlist_menu(self, *args, song=None):
+    def update_playlist_menu(self, *args, song=None, open_menu=False):
+        app.sync_playlist(
+            callback=lambda playlist: self.create_playlist_menu(
+                playlist, song=song, open_menu=open_menu),
+        )
+
+    @log
+    def create_playlist_menu(self, playlist, song=None, open_menu=False):
         from kivymd.uix.bottomsheet import MDCustomBottomSheet
-        self.app.playlist = self.app.db.get_playlist()
+        self.app.playlist = playlist
         self.playlist_menu = MDCustomBottomSheet(
             screen=Factory.PlaylistLayout(height=dp(65 * len(app.playlist.tracks))),
         )
@@ -464,6 +482,8 @@ class MainPage(FloatLayout):
                 item.theme_text_color = 'Custom'
                 item.text_color = (1, 1, 1, 1)
             self.playlist_menu.screen.songs_grid.add_widget(item)
+        if open_menu:
+            self.playlist_menu.open()
 
     def open_song_menu(self, i):
         # adding right-side icons
@@ -534,14 +554,14 @@ class MainPage(FloatLayout):
         if song in app.favorites:
             favorited = False
             song.date_favorited = None
-            app.favorites.remove(song)
-            app.db.remove_favorites_track(song)
+            app.favorites.discard(song)
+            app.db_worker.submit(app.db.remove_favorites_track, song)
             msg = 'Song unfavorited'
         else:
             favorited = True
             song.date_favorited = time()
-            app.favorites.append(song)
-            app.db.add_favorites_track(song)
+            app.favorites.add(song)
+            app.db_worker.submit(app.db.add_favorites_track, song)
             msg = 'Song favorited'
 
         # Correct main favorite button if user (un)favorited item == current song
@@ -583,6 +603,7 @@ class MainPage(FloatLayout):
             image.source = None
             image.bind(on_load=self.save_cover_art)
 
+    @log
     def update_song_info(self, song):
         self.ids.title.text = song.name
         self.ids.artist.text = song.artist
@@ -652,6 +673,9 @@ class MainApp(MDApp):
     artists = []
     genres = []
     db = Database()
+    db_worker = DatabaseWorker()
+    playlist = None
+    playlist_version = None
     song = None
     main_page = None
     volume = 0.5
@@ -686,6 +710,7 @@ class MainApp(MDApp):
             os.mkdir(images_path)
             Logger.info('DIR: created images temp directory')
         self.images_path = images_path
+        self.api.use_cache(join(storage_path, 'responses'))
 
         self.load_first_page()
         Logger.debug('DISPLAY: Loaded first page.')
@@ -693,6 +718,7 @@ class MainApp(MDApp):
             Clock.schedule_once(remove_splash_screen, 1)
         return self.nav_layout
 
+    @log
     def complete_ui(self):
         from kivy.lang import Builder
         import settings_page
@@ -709,12 +735,37 @@ class MainApp(MDApp):
         settings_screen.add_widget(app.settings_page)
         self.screen_manager.add_widget(settings_screen)
 
+    def sync_playlist(self, callback=None):
+        """Brings app.playlist up to date with the database.
+
+        Only what changed since the last sync is read from the database,
+        on the database worker. The changes are applied on the main thread.
+
+        Args:
+            callback (callable, optional): Called with the updated playlist.
+        """
+        def apply(changes):
+            self.playlist = changes.apply(self.playlist)
+            self.playlist_version = changes.version
+            if callback is not None:
+                callback(self.playlist)
+
+        self.db_worker.submit(
+            self.db.get_playlist_changes,
+            self.playlist_version if self.playlist is not None else None,
+            callback=apply,
+        )
+
+    @log
     def load_first_page(self, *args):
+        self.db.migrate()
         if user := self.db.get_user():
             self.main_page = page = MainPage()
             self.nav_drawer.type = 'modal'
 
-            self.playlist = self.db.get_playlist()
+            changes = self.db.get_playlist_changes()
+            self.playlist = changes.apply(None)
+            self.playlist_version = changes.version
             self.favorites = self.db.get_favorites()
             if user['dark_mode']:
                 self.theme_cls.theme_style = "Dark"
@@ -809,20 +860,38 @@ class MainApp(MDApp):
             self.screen_manager.add_widget(start_screen)
 
     def on_pause(self):
-        self.on_stop()
+        # The app may be resumed, so the worker keeps running.
+        self.submit_save_state()
         return True
 
     def on_stop(self):
-        if app.song and self.db.get_user():
+        Logger.debug('API: Connections: %s', self.api.sender.connection_stats())
+        self.submit_save_state()
+        # Let the state be saved before closing the database.
+        self.db_worker.shutdown(wait=True)
+        self.db.close()
+
+    def submit_save_state(self):
+        if app.song:
             song_pos = self.main_page.playback_slider.value
-            self.db.update_last_pos(song_pos)
-            self.db.update_volume(self.volume)
+            cached = {song.id for song in self.playlist.tracks}
+            cached.update(song.id for song in self.favorites)
+            self.db_worker.submit(self.save_state, song_pos, self.volume, cached)
+
+    @log
+    def save_state(self, song_pos, volume, cached):
+        """Saves the player's state and cleans up the cache.
+
+        Runs on the database worker.
+        """
+        if self.db.get_user():
+            with self.db.transaction():
+                self.db.update_last_pos(song_pos)
+                self.db.update_volume(volume)
             # Clean up cached cover arts
             images = [f
                       for f in os.listdir(self.images_path)
                       if os.path.isfile(os.path.join(self.images_path, f))]
-            cached = [song.id for song in self.playlist.tracks]
-            cached.extend([song.id for song in self.favorites])
             for image in images:
                 id = int(image[:-4])
                 if id not in cached:
@@ -831,9 +900,11 @@ class MainApp(MDApp):
 
     def on_resume(self):
         # update playback slider
-        if app.song and self.db.get_user():
-            self.playlist = self.db.get_playlist()
-            self.play_button.load_song(self.playlist.current_track)
+        if app.song:
+            self.sync_playlist(
+                callback=lambda playlist: self.play_button.load_song(
+                    playlist.current_track)
+            )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,195 @@
+"""Endless play queue that fetches recommendations ahead of time."""
+import logging
+import threading
+from collections import deque
+
+Logger = logging.getLogger('gtplayer')
+
+
+class PlayQueue:
+    """Keeps a playlist stocked with upcoming tracks.
+
+    Whenever fewer than ``watermark`` tracks are left after the current
+    one, more are fetched on a background thread until there are
+    ``lookahead`` of them. Fetched tracks that are already in the playlist
+    or were among the last ``history_size`` played are dropped, so the
+    queue doesn't repeat itself. If ``attempts`` fetches in a row bring
+    nothing new, the recently played tracks among the last fetch are let
+    in, least recently played first, rather than letting the queue run dry.
+
+    The playlist is only changed while holding :attr:`lock`; callers that
+    read it from another thread should hold it as well.
+
+    Args:
+        playlist (Playlist): the playlist to extend.
+        fetch (Callable): called without arguments on the refill thread;
+            returns a list of songs. It may raise, in which case the
+            refill is retried on the next call to :meth:`next`.
+        on_refill (Callable, optional): Called on the refill thread with
+            each batch of fetched songs before it's appended to the
+            playlist. If it raises, the batch is dropped.
+        lookahead (int): number of upcoming tracks to fetch up to.
+        watermark (int): number of upcoming tracks below which a refill
+            starts.
+        history_size (int): number of recent plays not to queue again.
+        recent (Iterable, optional): IDs of recently played tracks, most
+            recent last, to seed the history with.
+        attempts (int): fetches in a row with nothing new after which
+            recently played tracks are queued again.
+    """
+
+    def __init__(self, playlist, fetch, on_refill=None, lookahead=10,
+                 watermark=3, history_size=200, recent=(), attempts=3):
+        if not 0 <= watermark <= lookahead:
+            raise ValueError("watermark must be between 0 and lookahead")
+        self.playlist = playlist
+        self.fetch = fetch
+        self.on_refill = on_refill
+        self.lookahead = lookahead
+        self.watermark = watermark
+        self.attempts = attempts
+        self.lock = threading.RLock()
+        self._played = deque(maxlen=history_size)
+        self._played_ids = set()
+        for id in recent:
+            self._remember(id)
+        self._refill_thread = None
+        self._refilled = threading.Condition(self.lock)
+
+    @property
+    def remaining(self):
+        """Number of tracks after the current one."""
+        with self.lock:
+            return len(self.playlist.tracks) - self.playlist._current - 1
+
+    @property
+    def is_refilling(self):
+        thread = self._refill_thread
+        return thread is not None and thread.is_alive()
+
+    def _remember(self, id):
+        if len(self._played) == self._played.maxlen:
+            self._played_ids.discard(self._played[0])
+        self._played.append(id)
+        self._played_ids.add(id)
+
+    def played(self, song):
+        """Records song as played so later refills skip it."""
+        with self.lock:
+            if song.id in self._played_ids:
+                self._played.remove(song.id)
+            self._remember(song.id)
+
+    def next(self, timeout=0):
+        """Moves to the next track and returns it.
+
+        Args:
+            timeout (float): Seconds to wait for a refill when there's no
+                next track. The default doesn't wait.
+
+        Returns:
+            Song: the next track, or None if there's none yet.
+        """
+        with self.lock:
+            if self.remaining == 0 and timeout:
+                self.refill()
+                self._refilled.wait_for(lambda: self.remaining > 0, timeout)
+            if self.remaining == 0:
+                self.refill()
+                return None
+            song = self.playlist.next()
+            self.played(song)
+            if self.remaining < self.watermark:
+                self.refill()
+            return song
+
+    def refill(self):
+        """Starts fetching tracks in the background, unless it's already at it.
+
+        Returns:
+            bool: whether a new refill was started.
+        """
+        with self.lock:
+            if self.is_refilling or self.remaining >= self.lookahead:
+                return False
+            self._refill_thread = threading.Thread(
+                target=self._refill, name='PlayQueue refill', daemon=True)
+            self._refill_thread.start()
+            return True
+
+    def _refill(self):
+        added = []
+        stale = 0
+        while True:
+            with self.lock:
+                missing = self.lookahead - self.remaining
+            if missing <= 0:
+                break
+            try:
+                songs = self.fetch()
+            except Exception as e:
+                Logger.error('QUEUE: Refill failed. Reason: %s', e)
+                break
+            with self.lock:
+                new = list(self.unique(songs))[:missing]
+                if not new:
+                    stale += 1
+                    Logger.debug('QUEUE: Recommendations had nothing new (%d/%d).',
+                                 stale, self.attempts)
+                    if stale >= self.attempts:
+                        new = self.least_recent(songs)[:missing]
+                        Logger.debug('QUEUE: Queued %d recently played tracks.',
+                                     len(new))
+                else:
+                    stale = 0
+            # Saved before they're queued, so whoever gets them from
+            # next() can look them up.
+            if new and self.on_refill is not None:
+                try:
+                    self.on_refill(new)
+                except Exception as e:
+                    Logger.error('QUEUE: Saving the refill failed. Reason: %s', e)
+                    break
+            with self.lock:
+                for song in new:
+                    self.playlist.tracks.append(song)
+                added.extend(new)
+                self._refilled.notify_all()
+            if not new and stale >= self.attempts:
+                break
+        Logger.debug('QUEUE: Added %d tracks, %d upcoming.', len(added), self.remaining)
+
+    def unique(self, songs):
+        """Yields the songs that aren't queued or recently played."""
+        seen = set()
+        for song in songs:
+            if (song.id in seen
+                    or song.id in self._played_ids
+                    or song in self.playlist.tracks):
+                continue
+            seen.add(song.id)
+            yield song
+
+    def least_recent(self, songs):
+        """Returns the songs that aren't queued, least recently played first."""
+        order = {id: i for i, id in enumerate(self._played)}
+        seen = set()
+        songs = [song for song in songs
+                 if song.id not in seen and not seen.add(song.id)
+                 and song not in self.playlist.tracks]
+        return sorted(songs, key=lambda song: order.get(song.id, -1))
+
+    def trim(self, keep):
+        """Removes all but the last keep played tracks and returns them."""
+        with self.lock:
+            excess = self.playlist._current - keep
+            if excess <= 0:
+                return []
+            removed = self.playlist.tracks[:excess]
+            del self.playlist.tracks[:excess]
+            self.playlist._current -= excess
+            return removed
+
+    def __repr__(self):
+        return (f'PlayQueue({self.playlist!r}, remaining={self.remaining},'
+                f' refilling={self.is_refilling})')
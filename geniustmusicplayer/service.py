@@ -1,3 +1,4 @@
+import atexit
 import threading
 import os
 from os import environ
@@ -10,9 +11,11 @@ from android import api_version
 from android.storage import app_storage_path
 from jnius import autoclass
 
-from utils import save_song, Playlist
+from utils import log
 from api import API
+from cache import AudioCache
 from db import Database
+from play_queue import PlayQueue
 
 service = autoclass('org.kivy.android.PythonService').mService
 context = service.getApplication().getApplicationContext()
@@ -53,30 +56,49 @@ class OSCSever:
         self.osc.bind(b'/stop', self.pause)
         self.osc.bind(b'/unload', self.unload)
 
-        self.api = API()
+        self.api = API(cache_path=os.path.join(app_storage_path(), 'responses'))
         self.db = Database()
+        self.db.migrate()
         user = self.db.get_user()
         self.genres = user['genres']
         self.artists = user['artists']
         self.volume = user['volume']
         self.songs_path = user['songs_path']
-        self.playlist = self.db.get_playlist()
+        self.cache = AudioCache(self.songs_path)
+        self.cache.clean()
+        self.queue = PlayQueue(
+            None,
+            self.fetch_recommendations,
+            on_refill=self.on_refill,
+            recent=[song.id for song in reversed(self.db.get_recently_played(200))],
+        )
+        self.playlist_version = None
+        self.sync_playlist()
         self.waiting_for_load = False
         self.seek_pos = 0
         self.downloading = None
         self.waiting_for_download = False
         self.downloads = []
 
+    @property
+    def playlist(self):
+        return self.queue.playlist
+
+    @playlist.setter
+    def playlist(self, playlist):
+        self.queue.playlist = playlist
+
     def check_pos(self, *args):
         if self.song.state == "play" and self.song.length - self.song.get_pos() < 20:
-            next_song = self.playlist.preview_next()
-            if next_song is None or next_song.preview_file is None:
-                if next_song is None:
-                    self.playlist = self.get_new_playlist()
-                    next_song = self.playlist.preview_next()
+            with self.queue.lock:
+                next_song = self.playlist.preview_next()
+                if self.playlist.is_last:
+                    self.queue.refill()
+            if next_song is not None and self.cached_preview(next_song) is None:
                 Logger.debug('SERVICE: Preloading next song.')
                 self.download_song(next_song)
 
+    @log
     def thread_download_song(self, song):
         self.downloads.append(song.id)
         try:
@@ -84,13 +106,28 @@ class OSCSever:
         except Exception as e:
             Logger.error("SERVICE: Download failed. Reason: %s", e)
         else:
-            song.preview_file = save_song(self.songs_path, song, res)
+            song.preview_file = self.cache.put(song, res)
             self.db.update_track(song, 'preview_file', song.preview_file)
             Logger.debug('SERVICE: Downloading song finished.')
+        finally:
+            self.db.connections.release()
         self.downloads.remove(song.id)
 
+    def cached_preview(self, song):
+        """Returns the path of the song's downloaded preview, or None."""
+        path = self.cache.get(song)
+        if (path is None
+            and song.preview_file
+                and os.path.isfile(song.preview_file)):
+            # Downloaded before there was a cache.
+            path = self.cache.adopt(song, song.preview_file)
+        if path != song.preview_file:
+            song.preview_file = path
+            self.db.update_track(song, 'preview_file', path)
+        return path
+
     def download_song(self, song):
-        if song.id not in self.downloads and song.preview_file is None:
+        if song.id not in self.downloads and self.cached_preview(song) is None:
             Logger.debug('SERVICE: Downloading %s.', song.id)
             t = threading.Thread(
                 target=self.thread_download_song,
@@ -99,29 +136,49 @@ class OSCSever:
             t.daemon = True
             t.start()
         else:
-            Logger.debug('SERVICE: Skipped downloading %s. Already in progress.',
-                         song.id)
-
-    def get_new_playlist(self):
-        Logger.debug('SERVICE: getting new playlist.')
-        req = self.api.get_recommendations(
+            Logger.debug('SERVICE: Skipped downloading %s. Already downloaded'
+                         ' or in progress.', song.id)
+
+    @log
+    def sync_playlist(self):
+        """Applies changes made to the playlist since the last sync."""
+        with self.queue.lock:
+            changes = self.db.get_playlist_changes(self.playlist_version)
+            self.playlist = changes.apply(self.playlist)
+            self.playlist_version = changes.version
+
+    @log
+    def fetch_recommendations(self):
+        Logger.debug('SERVICE: getting recommendations.')
+        return self.api.get_recommendations(
             self.genres,
             self.artists,
             song_type='preview',
+            # The queue needs new tracks every time.
+            use_cache=False,
         )
-        playlist = Playlist(req)
+
+    @log
+    def on_refill(self, songs):
+        """Saves the tracks the queue is adding and drops old played ones."""
+        try:
+            removed = self.queue.trim(keep=50)
+            with self.db.transaction():
+                for song in songs:
+                    self.db.add_playlist_track(song, -1)
+                for song in removed:
+                    self.db.remove_playlist_track(song)
+            # clean up played songs
+            favorites = self.db.get_favorites()
+            for song in removed:
+                if song not in favorites and song != self.song.song_object:
+                    Logger.debug("Service: Removed %s", song.id)
+                    self.cache.remove(song)
+        finally:
+            self.db.connections.release()
         self.osc.send_message(b'/update_playlist',
                               [],
                               *self.activity_server_address)
-        # clean up playlist songs
-        favorites = self.db.get_favorites()
-        for song in self.playlist.tracks:
-            if (song.preview_file
-                and song not in favorites
-                    and song != self.song.song_object):
-                Logger.debug("Service: Removed %s", song.id)
-                os.remove(song.preview_file)
-        return playlist
 
     def get_pos(self, *values):
         pos = self.song.get_pos() if self.song and self.song.is_prepared else 0
@@ -131,13 +188,20 @@ class OSCSever:
     def getaddress(self):
         return self.osc.getaddress()
 
+    @log
     def load(self, id):
         self.first_load = not getattr(self.song, "id", 0)
         self.song.id = id
         self.song.is_prepared = False
         Logger.debug('SERVICE: Loading %d.', id)
         song = self.db.get_track(id)
-        if song.preview_file is None and self.downloading != song.id:
+        if song is None:
+            # Queued but not saved yet, e.g. if saving the refill failed.
+            song = self.playlist.get_track(id=id)
+            if song is None:
+                Logger.error('SERVICE: %d is not in the playlist.', id)
+                return
+        if self.cached_preview(song) is None and self.downloading != song.id:
             Logger.debug('SERVICE: %d is not downloaded.', id)
             self.download_song(song)
         if song.id in self.downloads:
@@ -151,17 +215,29 @@ class OSCSever:
         self.song.load(song.preview_file)
         self.song.song_object = song
         self.db.update_current_track(song)
-        self.playlist = self.db.get_playlist()
+        self.sync_playlist()
         self.song.is_prepared = True
         self.update_notification()
         Logger.debug('SERVICE: Song loaded.')
 
+    @log
     def load_play(self, id, volume=None):
         Logger.debug('SERVICE: Loading and playing %d.', id)
+        self.record_skip()
         self.pause()
         self.load(id)
         self.play(0, volume if volume is not None else self.volume)
+        if self.song.is_prepared:
+            self.queue.played(self.song.song_object)
+            self.db.record_event(self.song.song_object, 'play')
 
+    def record_skip(self):
+        """Records the current song as skipped if it's still playing."""
+        song = getattr(self.song, "song_object", None)
+        if song is not None and self.song.is_prepared and self.song.state == 'play':
+            self.db.record_event(song, 'skip', self.song.get_pos())
+
+    @log
     def play(self, seek, volume):
         if not self.song.is_prepared:
             song_id = getattr(self.song, "id", None)
@@ -216,16 +292,27 @@ class OSCSever:
 
     def on_complete(self, *values):
         Logger.debug('SERVICE -> ACTIVITY: /set_complete')
+        if (song := getattr(self.song, "song_object", None)) is not None:
+            self.db.record_event(song, 'complete', self.song.length)
         self.osc.send_message(b'/set_complete', [True], *self.activity_server_address)
         self.play_next()
 
+    @log
     def play_next(self):
         Logger.debug('SERVICE: Playing next.')
+        # Only waits if the queue ran dry, e.g. while offline.
+        song = self.queue.next(timeout=self.api.sender.timeout)
+        if song is None:
+            Logger.error('SERVICE: No next song to play.')
+            # Keep playing the current song, and tell the activity its
+            # state so it doesn't wait for a next one.
+            self.osc.send_message(
+                b'/set_state',
+                [self.song.state.encode()],
+                *self.activity_server_address)
+            return
+        self.record_skip()
         self.stop()
-        if self.playlist.is_last:
-            self.playlist = self.get_new_playlist()
-        song = self.playlist.next()
-        self.db.update_playlist(self.playlist)
         self.load_play(song.id)
 
     def play_previous(self):
@@ -352,6 +439,7 @@ if __name__ == '__main__':
     activity_ip, activity_port, service_port = args[0], int(args[1]), int(args[2])
     activity_address = (activity_ip, activity_port)
     osc = OSCSever(activity_address, service_port)
+    atexit.register(osc.db.close)
     osc.download_song(osc.playlist.current_track)
     osc.load(osc.playlist.current_track.id)
     Logger.debug('SERVICE: Started OSC server.')
@@ -1,5 +1,3 @@
-from time import time
-
 from kivy.uix.floatlayout import FloatLayout
 from kivy.uix.boxlayout import BoxLayout
 from kivy.clock import Clock, mainthread
@@ -12,6 +10,7 @@ from kivymd.uix.dialog import MDDialog
 from kivymd.uix.list import OneLineAvatarIconListItem
 from android.runnable import run_on_ui_thread
 
+from artist_search import ArtistSearch
 from utils import switch_screen, create_snackbar
 
 
@@ -125,15 +124,13 @@ class GenresDialog:
     def select_genres(self):
         if not self.genres_dialog:
             def retry(*args):
-                self.retry_event.cancel()
                 self.snackbar.dismiss()
                 self.select_genres()
 
             def create_genres_grid(*args):
                 if req.status_code != 200:
-                    msg = "Failed to get genres. Reyting in 3 seconds."
+                    msg = "Failed to get genres."
                     self.snackbar = create_snackbar(msg, retry)
-                    self.retry_event = Clock.schedule_once(retry, 3)
                     self.snackbar.open()
                     return
                 genres = req.response.get('genres')
@@ -218,7 +215,6 @@ class StartPage(FloatLayout):
 
         def retry(*args):
             self.snackbar.dismiss()
-            self.retry_event.cancel()
             self.get_preferences(code, platform)
             return
 
@@ -240,9 +236,8 @@ class StartPage(FloatLayout):
                     self.app.screen_manager.switch_to(self.parent)
                     self.snackbar.open()
             else:
-                msg = "Failed to get preferences. Retrying in 3 seconds."
+                msg = "Failed to get preferences."
                 self.snackbar = create_snackbar(msg, retry)
-                self.retry_event = Clock.schedule_once(retry, 3)
                 self.snackbar.open()
 
         if self.get_preferences_trigger is None:
@@ -277,7 +272,6 @@ class StartPage(FloatLayout):
 
         def retry(*args):
             self.snackbar.dismiss()
-            self.retry_event.cancel()
             self.submit_age(age)
             return
 
@@ -289,9 +283,8 @@ class StartPage(FloatLayout):
                 self.age_dialog.dismiss()
                 switch_screen(ArtistsPage(), 'artists_page')
             else:
-                msg = "Failed to get genrs. Retrying in 3 seconds."
+                msg = "Failed to get genres."
                 self.snackbar = create_snackbar(msg, retry)
-                self.retry_event = Clock.schedule_once(retry, 3)
                 self.snackbar.open()
 
         self.loading.active = True
@@ -346,7 +339,6 @@ class ArtistsPage(FloatLayout):
     def finish(self):
         def retry(*args):
             self.snackbar.dismiss()
-            self.retry_event.cancel()
             self.finish()
 
         def get_tracks(*args):
@@ -357,9 +349,8 @@ class ArtistsPage(FloatLayout):
                 self.save_preferences(self.app.playlist)
                 self.app.load_first_page()
             else:
-                msg = "Failed to get playlist. Retrying in 3 seconds."
+                msg = "Failed to get playlist."
                 self.snackbar = create_snackbar(msg, retry)
-                self.retry_event = Clock.schedule_once(retry, 3)
                 self.snackbar.open()
 
         self.loading.active = True
@@ -410,40 +401,36 @@ class Search(FloatLayout):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self.app = MDApp.get_running_app()
-        self.last_input = time()
-        self.current_input = time()
-        self.event = Clock.schedule_interval(self.search_artists, 0.01)
+        self.search = ArtistSearch(self.app.api, self.add_items, self.search_failed)
+        # start the search when the user stops typing
+        self.search_trigger = Clock.create_trigger(self.search_artists, 0.3)
         self.loading = loading_spinner(pos_hint={'center_x': .5, 'center_y': .5})
-        self.snackbar_retry = False
         self.add_widget(self.loading)
 
     def register_input(self):
-        self.current_input = time()
+        self.search_trigger.cancel()
+        self.search_trigger()
 
     def search_artists(self, *args):
-        def add_items(*args):
+        text = self.ids.search_field.text
+        if len(text) > 2:
+            self.loading.active = True
+            self.search.search(text)
+        else:
+            self.search.cancel()
             self.loading.active = False
             self.ids.hits.clear_widgets()
-            if req.status_code == 200:
-                for artist in req.response['artists']:
-                    self.ids.hits.add_widget(CustomOneLineListItem(text=artist))
-            else:
-                Logger.error('search_artists: failed payload: %s', req.response)
-                create_snackbar("Search failed.", self.search_artists).open()
-                self.snackbar_retry = True
 
-        text = self.ids.search_field.text
-        # start the search when the user stops typing
-        if (self.snackbar_retry
-                or (len(text) > 2 and self.current_input - self.last_input > 0.3)):
-            if self.loading.active is False:
-                self.loading.active = True
-            self.snackbar_retry = False
-            self.last_input = time()
-            trigger = Clock.create_trigger(add_items)
-            req = self.app.api.search_artists(text, trigger=trigger)
-        elif len(text) == 0:
-            self.ids.hits.clear_widgets()
+    def add_items(self, query, artists, final):
+        self.loading.active = not final
+        self.ids.hits.clear_widgets()
+        for artist in artists:
+            self.ids.hits.add_widget(CustomOneLineListItem(text=artist))
+
+    def search_failed(self, query):
+        Logger.error('search_artists: search failed for %r', query)
+        self.loading.active = False
+        create_snackbar("Search failed.", self.search_artists).open()
 
 # -------------------- OAuth Info --------------------
 
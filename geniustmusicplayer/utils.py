@@ -1,11 +1,54 @@
-import functools
-import inspect
+import atexit
 import json
+import math
+import os
+import struct
+import threading
+import weakref
+from collections import deque
 from functools import wraps
-from os.path import join
+from time import perf_counter_ns
+
+# Set GTPLAYER_TRACE to a file path to trace the functions decorated with
+# log. The trace is written there when the process exits, with {pid}
+# replaced by the process id so the app and the service don't overwrite
+# each other's traces. Open it in chrome://tracing or ui.perfetto.dev.
+TRACE_PATH = os.environ.get('GTPLAYER_TRACE')
+# Number of most recent spans kept for the trace.
+TRACE_BUFFER_SIZE = 50000
+_spans = deque(maxlen=TRACE_BUFFER_SIZE)
 
 
 class Song:
+    # Attributes in the order they're serialized. Slots keep songs small,
+    # since the playlist, favorites and search results all hold many.
+    fields = (
+        'id', 'name', 'artist', 'genres', 'id_spotify', 'isrc', 'cover_art',
+        'preview_url', 'download_url', 'preview_file', 'download_file',
+        'date_favorited',
+    )
+    __slots__ = fields + ('__weakref__',)
+
+    # Weak references to the live Song of every track id, see Song.shared.
+    # References to dead songs are swept out once there are twice as many
+    # entries as after the last sweep; that's cheaper than a callback per
+    # song, which a WeakValueDictionary would run.
+    _instances = {}
+    _instances_limit = 1024
+    _instances_lock = threading.Lock()
+    # Fields that shared doesn't clear when it's given an empty value, since
+    # the other source may not know them yet.
+    _kept_fields = frozenset(('genres', 'cover_art', 'preview_file', 'download_file'))
+    _field_names = frozenset(fields)
+
+    # Binary format: format version, id, date_favorited (NaN when None) and
+    # the byte length of every string field (-1 when None), followed by the
+    # UTF-8 strings. Genres are joined into one string by GENRE_SEPARATOR.
+    _binary_version = 1
+    _binary_header = struct.Struct('<Bqd10i')
+    _string_fields = fields[1:-1]
+    GENRE_SEPARATOR = '\x1f'
+
     def __init__(self, id, name, artist, genres=None,
                  id_spotify=None, isrc=None, cover_art=None,
                  preview_url=None, download_url=None, preview_file=None,
@@ -26,6 +69,52 @@ class Song:
         self.download_file = download_file
         self.date_favorited = date_favorited
 
+    @classmethod
+    def shared(cls, id, **fields):
+        """Returns the one Song of the process for id, updated with fields.
+
+        Songs are kept while anything references them, so the playlist,
+        the favorites and the player all hold the same object for a track,
+        and changes to it are seen by all of them. A new Song is created
+        if none is alive.
+
+        Args:
+            id (int): the track's id.
+            **fields: the song's attributes, as Song takes them. Fields that
+                aren't given are left as they are, and empty genres, cover
+                art and file paths don't replace known ones.
+
+        Returns:
+            Song: the shared song.
+        """
+        song = cls._get_shared(id)
+        if song is None:
+            with cls._instances_lock:
+                song = cls._get_shared(id)
+                if song is None:
+                    song = cls(id, **fields)
+                    cls._instances[id] = weakref.ref(song)
+                    if len(cls._instances) > cls._instances_limit:
+                        cls._sweep_shared()
+                    return song
+        kept = cls._kept_fields
+        for field in cls._field_names.intersection(fields):
+            value = fields[field]
+            if value or field not in kept:
+                setattr(song, field, value)
+        return song
+
+    @classmethod
+    def _get_shared(cls, id):
+        ref = cls._instances.get(id)
+        return ref() if ref is not None else None
+
+    @classmethod
+    def _sweep_shared(cls):
+        cls._instances = {id: ref for id, ref in cls._instances.items()
+                          if ref() is not None}
+        cls._instances_limit = max(len(cls._instances) * 2, 1024)
+
     def to_dict(self):
         return dict(
             id=self.id,
@@ -44,24 +133,178 @@ class Song:
     def to_json(self):
         return json.dumps(self.to_dict())
 
+    def to_bytes(self):
+        """Returns the song in the compact binary format."""
+        strings = []
+        lengths = []
+        for field in self._string_fields:
+            value = getattr(self, field)
+            if field == 'genres':
+                value = self.GENRE_SEPARATOR.join(value)
+            if value is None:
+                lengths.append(-1)
+            else:
+                value = value.encode()
+                strings.append(value)
+                lengths.append(len(value))
+        date = self.date_favorited
+        header = self._binary_header.pack(
+            self._binary_version,
+            self.id,
+            date if date is not None else math.nan,
+            *lengths,
+        )
+        return header + b''.join(strings)
+
+    @classmethod
+    def from_bytes(cls, data):
+        """Reads a song written by :meth:`to_bytes`.
+
+        Raises:
+            ValueError: if data is in an unknown format version.
+        """
+        version, id, date, *lengths = cls._binary_header.unpack_from(data)
+        if version != cls._binary_version:
+            raise ValueError(f"Unknown song format version {version}")
+        song = cls.__new__(cls)
+        song.id = id
+        song.date_favorited = None if math.isnan(date) else date
+        offset = cls._binary_header.size
+        for field, length in zip(cls._string_fields, lengths):
+            if length == -1:
+                value = None
+            else:
+                value = data[offset:offset + length].decode()
+                offset += length
+            setattr(song, field, value)
+        song.genres = song.genres.split(cls.GENRE_SEPARATOR) if song.genres else []
+        return song
+
     @classmethod
     def bytes_to_song(cls, song):
+        """Reads a song sent as JSON or in the binary format."""
         if isinstance(song, bytes):
-            song = cls(**json.loads(song.decode()))
+            if song[:1] == b'{':
+                song = cls(**json.loads(song.decode()))
+            else:
+                song = cls.from_bytes(song)
         return song
 
+    def update(self, other):
+        """Copies the attributes of other into this song."""
+        for field in self.fields:
+            setattr(self, field, getattr(other, field))
+
     def __eq__(self, other):
         return bool(isinstance(other, Song) and self.id == other.id)
 
+    def __hash__(self):
+        return hash(self.id)
+
     def __repr__(self):
         return f'Song(artist={self.artist!r}, song={self.name!r})'
 
 
+class TrackList(list):
+    """List of songs that finds a song's index by its id in O(1).
+
+    The id -> index map is built on the first lookup after the list
+    changes. Appending keeps it up to date, so a playlist that's built
+    track by track isn't reindexed for every track.
+    """
+
+    def __init__(self, tracks=()):
+        super().__init__(tracks)
+        self._indexes = None
+
+    def find(self, id):
+        """Returns the index of the first track with id, or -1."""
+        if self._indexes is None:
+            indexes = {}
+            for i, track in enumerate(self):
+                indexes.setdefault(track.id, i)
+            self._indexes = indexes
+        return self._indexes.get(id, -1)
+
+    def __contains__(self, track):
+        if isinstance(track, Song):
+            return self.find(track.id) != -1
+        return super().__contains__(track)
+
+    def index(self, track, *args):
+        if isinstance(track, Song) and not args:
+            i = self.find(track.id)
+            if i == -1:
+                raise ValueError(f'{track!r} is not in list')
+            return i
+        return super().index(track, *args)
+
+    def append(self, track):
+        super().append(track)
+        if self._indexes is not None:
+            self._indexes.setdefault(track.id, len(self) - 1)
+
+    # Every other change moves tracks, so the map is rebuilt.
+    def extend(self, tracks):
+        super().extend(tracks)
+        self._indexes = None
+
+    def insert(self, index, track):
+        super().insert(index, track)
+        self._indexes = None
+
+    def remove(self, track):
+        super().remove(track)
+        self._indexes = None
+
+    def pop(self, index=-1):
+        track = super().pop(index)
+        self._indexes = None
+        return track
+
+    def clear(self):
+        super().clear()
+        self._indexes = None
+
+    def sort(self, *args, **kwargs):
+        super().sort(*args, **kwargs)
+        self._indexes = None
+
+    def reverse(self):
+        super().reverse()
+        self._indexes = None
+
+    def __setitem__(self, index, value):
+        super().__setitem__(index, value)
+        self._indexes = None
+
+    def __delitem__(self, index):
+        super().__delitem__(index)
+        self._indexes = None
+
+    def __iadd__(self, tracks):
+        self.extend(tracks)
+        return self
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self._indexes = None
+        return self
+
+
 class Playlist:
     def __init__(self, tracks: list, current=-1) -> None:
         self.tracks = tracks
         self._current = current
 
+    @property
+    def tracks(self):
+        return self._tracks
+
+    @tracks.setter
+    def tracks(self, tracks):
+        self._tracks = tracks if isinstance(tracks, TrackList) else TrackList(tracks)
+
     @property
     def track_names(self):
         return [track.name for track in self.tracks]
@@ -106,7 +349,29 @@ class Playlist:
         return self.tracks[self._current]
 
     def remove(self, track):
-        self.tracks.remove(track)
+        index = self.tracks.index(track)
+        del self.tracks[index]
+        if index < self._current:
+            self._current -= 1
+        elif index == self._current == len(self.tracks):
+            # The last track was current, so the new last one is.
+            self._current -= 1
+
+    def insert(self, index, track):
+        """Inserts track before index, keeping the current track current."""
+        if index < 0:
+            index = max(len(self.tracks) + index, 0)
+        self.tracks.insert(index, track)
+        if self._current != -1 and index <= self._current:
+            self._current += 1
+
+    def move(self, track, index):
+        """Moves track to index, keeping the current track current."""
+        current = self.current_track
+        del self.tracks[self.tracks.index(track)]
+        self.tracks.insert(index, track)
+        if current is not None:
+            self._current = self.tracks.find(current.id)
 
     def set_current(self, track):
         self._current = self.tracks.index(track)
@@ -114,8 +379,11 @@ class Playlist:
     def get_track(self, id=None, name=None):
         if not any([id, name]):
             raise AssertionError('You must supply id or name.')
+        if id:
+            index = self.tracks.find(id)
+            return self.tracks[index] if index != -1 else None
         for track in self.tracks:
-            if (id and track.id == id) or (name and track.name == name):
+            if track.name == name:
                 return track
 
     def to_dict(self):
@@ -134,6 +402,56 @@ class Playlist:
         return f'Playlist({len(self.tracks)} Tracks, current={self._current})'
 
 
+class Favorites:
+    """The user's favorite songs in the order they were favorited.
+
+    Songs are kept in a dict keyed by id, so checking, adding and removing
+    a song don't search the collection.
+    """
+
+    def __init__(self, songs=()) -> None:
+        self._songs = {}
+        for song in songs:
+            self.add(song)
+
+    def add(self, song):
+        """Adds song, or moves it to its new date if it's already there."""
+        self._songs.pop(song.id, None)
+        if self._songs and song.date_favorited is not None:
+            last = self._songs[next(reversed(self._songs))].date_favorited
+            if last is not None and song.date_favorited < last:
+                songs = sorted([*self._songs.values(), song],
+                               key=lambda s: s.date_favorited or 0)
+                self._songs = {s.id: s for s in songs}
+                return
+        self._songs[song.id] = song
+
+    def remove(self, song):
+        """Removes song. Raises KeyError if it isn't a favorite."""
+        del self._songs[song.id]
+
+    def discard(self, song):
+        self._songs.pop(song.id, None)
+
+    def get(self, id):
+        return self._songs.get(id)
+
+    def __contains__(self, song):
+        return getattr(song, 'id', None) in self._songs
+
+    def __iter__(self):
+        return iter(self._songs.values())
+
+    def __reversed__(self):
+        return reversed(self._songs.values())
+
+    def __len__(self):
+        return len(self._songs)
+
+    def __repr__(self):
+        return f'Favorites({len(self._songs)} Tracks)'
+
+
 def create_snackbar(text, callback):
     from kivy.core.window import Window
     from kivymd.uix.snackbar import Snackbar
@@ -156,44 +474,61 @@ def create_snackbar(text, callback):
     return snackbar
 
 
-def get_class_that_defined_method(meth):
-    if isinstance(meth, functools.partial):
-        return get_class_that_defined_method(meth.func)
-    if (inspect.ismethod(meth)
-        or (inspect.isbuiltin(meth)
-            and getattr(meth, '__self__', None) is not None
-            and getattr(meth.__self__, '__class__', None))):
-        for cls in inspect.getmro(meth.__self__.__class__):
-            if meth.__name__ in cls.__dict__:
-                return cls
-        meth = getattr(meth, '__func__', meth)  # fallback to __qualname__ parsing
-    if inspect.isfunction(meth):
-        cls = getattr(inspect.getmodule(meth),
-                      meth.__qualname__.split('.<locals>', 1)[0].rsplit('.', 1)[0],
-                      None)
-        if isinstance(cls, type):
-            return cls
-    return getattr(meth, '__objclass__', None)  # handle special descriptor objects
+def log(func):
+    """Traces calls to func when tracing is enabled.
 
+    Whether tracing is enabled is decided when the function is decorated,
+    from GTPLAYER_TRACE. When it isn't, func is returned undecorated, so it
+    costs nothing. When it is, the start and duration of every call are
+    kept in a ring buffer that :func:`export_trace` writes out.
+    """
+    if not TRACE_PATH:
+        return func
 
-def log(func):
-    """logs entering and exiting functions for debugging."""
-    # from kivy.logger import Logger
+    name = f'{func.__module__}.{func.__qualname__}'
+    spans = _spans
 
     @wraps(func)
     def wrapper(*args, **kwargs):
-        cls = get_class_that_defined_method(func)
-        if cls is not None:
-            cls = cls.__name__
-        # Logger.debug("Entering: %s.%s", cls, func.__name__)
-        result = func(*args, **kwargs)
-        # Logger.debug("Exiting: %s.%s (return value: %s)",
-        #             cls, func.__name__, repr(result))
-        return result
+        start = perf_counter_ns()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            spans.append((name, start, perf_counter_ns() - start,
+                          threading.get_ident()))
 
     return wrapper
 
 
+def export_trace(path):
+    """Writes the traced spans to path in the Chrome trace event format.
+
+    Returns:
+        int: number of spans written.
+    """
+    pid = os.getpid()
+    spans = list(_spans)
+    events = [
+        dict(name=name, cat='gtplayer', ph='X', pid=pid, tid=tid,
+             ts=start / 1000, dur=duration / 1000)
+        for name, start, duration, tid in spans
+    ]
+    threads = {tid: thread.name for thread in threading.enumerate()
+               if (tid := thread.ident) is not None}
+    events.extend(
+        dict(name='thread_name', ph='M', pid=pid, tid=tid,
+             args=dict(name=threads.get(tid, str(tid))))
+        for tid in {span[3] for span in spans}
+    )
+    with open(path, 'w') as f:
+        json.dump(dict(traceEvents=events, displayTimeUnit='ms'), f)
+    return len(spans)
+
+
+if TRACE_PATH:
+    atexit.register(lambda: export_trace(TRACE_PATH.format(pid=os.getpid())))
+
+
 @log
 def save_favorites(favorites):
     save_keys(favorites=[song.to_dict() for song in favorites])
@@ -208,24 +543,6 @@ def save_keys(**kwargs):
     app.store.put('user', **app.store['user'])
 
 
-def save_song(songs_path, song, data, preview=True):
-    song_name = clean_filename(
-        f'{song.artist} - {song.name}' + ('preview' if preview else '')
-    )
-    filename = join(songs_path, f'{song_name}.mp3')
-    with open(filename, 'wb') as f:
-        f.write(data)
-    return filename
-
-
-def clean_filename(s):
-    return "".join(
-        i
-        for i in s
-        if i not in r"\/:*?<>|"
-    )
-
-
 @log
 def switch_screen(page, name):
     from kivymd.app import MDApp
@@ -0,0 +1,128 @@
+import pytest
+
+from utils import Song, Playlist, TrackList
+
+
+def make_songs(count, start=1):
+    return [Song(id=i, name=f'Song {i}', artist='Artist')
+            for i in range(start, start + count)]
+
+
+def assert_consistent(playlist, current=None):
+    """Checks every lookup against a scan of the tracks."""
+    tracks = playlist.tracks
+    for i, track in enumerate(tracks):
+        assert tracks.find(track.id) == i
+        assert tracks.index(track) == i
+        assert track in tracks
+        assert playlist.get_track(id=track.id) is track
+    missing = Song(id=-1, name='Missing', artist='Artist')
+    assert tracks.find(missing.id) == -1
+    assert missing not in tracks
+    assert playlist.get_track(id=missing.id) is None
+    with pytest.raises(ValueError):
+        tracks.index(missing)
+    if tracks:
+        assert 0 <= playlist._current < len(tracks)
+    if current is not None:
+        assert playlist.current_track is current
+
+
+@pytest.fixture
+def songs():
+    return make_songs(10)
+
+
+@pytest.fixture
+def playlist(songs):
+    return Playlist(list(songs), current=4)
+
+
+def test_tracks_are_a_track_list(playlist):
+    assert isinstance(playlist.tracks, TrackList)
+    playlist.tracks = make_songs(3)
+    playlist._current = 0
+    assert isinstance(playlist.tracks, TrackList)
+    assert_consistent(playlist)
+
+
+def test_set_current(playlist, songs):
+    for song in (songs[0], songs[-1], songs[7]):
+        playlist.set_current(song)
+        assert_consistent(playlist, current=song)
+
+
+def test_set_current_missing(playlist):
+    with pytest.raises(ValueError):
+        playlist.set_current(Song(id=-1, name='Missing', artist='Artist'))
+
+
+@pytest.mark.parametrize('index', [0, 3, 4, 5, 10, -1])
+def test_insert(playlist, songs, index):
+    new = Song(id=100, name='New', artist='Artist')
+    playlist.insert(index, new)
+    assert_consistent(playlist, current=songs[4])
+    assert new in playlist.tracks
+
+
+@pytest.mark.parametrize('index', [0, 3, 5, 9])
+def test_remove(playlist, songs, index):
+    playlist.remove(songs[index])
+    assert songs[index] not in playlist.tracks
+    assert_consistent(playlist, current=songs[4])
+
+
+def test_remove_current(playlist, songs):
+    playlist.remove(songs[4])
+    assert_consistent(playlist, current=songs[5])
+
+
+def test_remove_current_last(songs):
+    playlist = Playlist(list(songs), current=9)
+    playlist.remove(songs[9])
+    assert_consistent(playlist, current=songs[8])
+    assert playlist.is_last
+
+
+@pytest.mark.parametrize('track, index', [(0, 9), (9, 0), (2, 6), (4, 0), (4, 9), (6, 2)])
+def test_move(playlist, songs, track, index):
+    playlist.move(songs[track], index)
+    assert playlist.tracks[index] is songs[track]
+    assert_consistent(playlist, current=songs[4])
+
+
+def test_next_and_previous(playlist, songs):
+    for expected in songs[5:]:
+        assert playlist.next() is expected
+        assert_consistent(playlist, current=expected)
+    assert playlist.next() is songs[9]
+    for expected in reversed(songs[:9]):
+        assert playlist.previous() is expected
+        assert_consistent(playlist, current=expected)
+    assert playlist.previous() is songs[0]
+
+
+def test_append_after_lookup(playlist, songs):
+    assert playlist.tracks.find(songs[3].id) == 3
+    extra = make_songs(5, start=100)
+    for song in extra:
+        playlist.tracks.append(song)
+        assert_consistent(playlist, current=songs[4])
+    playlist.set_current(extra[-1])
+    assert playlist.is_last
+
+
+def test_slice_delete(playlist, songs):
+    assert playlist.tracks.find(songs[9].id) == 9
+    del playlist.tracks[:3]
+    playlist._current -= 3
+    for song in songs[:3]:
+        assert song not in playlist.tracks
+    assert_consistent(playlist, current=songs[4])
+
+
+def test_duplicate_ids_find_first():
+    song = Song(id=1, name='Song', artist='Artist')
+    tracks = TrackList([song, Song(id=2, name='Other', artist='Artist'), song])
+    assert tracks.find(1) == 0
+    assert tracks.index(song) == 0